@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Cold start import cost of job files, runjob.py and shipperd, measured with `python -X importtime` in fresh
+interpreters. Reports the median time spent importing modules (beyond the interpreter's own startup), the median
+process runtime and the heaviest dependencies pulled in.
+
+With --check, exits non-zero if an entry point imports a module it should leave alone - e.g. a job using only local
+tasks importing paramiko, or runjob.py importing CherryPy - or if its imports take longer than --max-ms.
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --check --max-ms 300 -n 10
+"""
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name, code run in a fresh interpreter, modules it must not import
+SCENARIOS = [
+    ("job file, local tasks", "from shipper.lib import ShipperJob, CmdTask, PythonTask; ShipperJob()",
+     ["paramiko", "git", "cherrypy"]),
+    ("job file, ssh tasks", "from shipper.lib import ShipperJob, SshConnection, SshTask, RsyncTask; ShipperJob()",
+     ["paramiko", "git", "cherrypy"]),
+    ("job file, git tasks", "from shipper.lib import ShipperJob, GitCheckoutTask; ShipperJob()",
+     ["paramiko", "cherrypy"]),
+    ("runjob.py", "import shipper.runjob", ["paramiko", "git", "cherrypy"]),
+    ("shipperd", "import shipper.server", ["paramiko", "git"]),
+]
+
+
+def importtime(code):
+    """
+    Run `code` in a fresh interpreter. Returns the process runtime and the parsed -X importtime output as a list of
+    (depth, module, cumulative seconds), in the order printed - a module's imports come before it.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+    started = perf_counter()
+    p = subprocess.run([sys.executable, "-X", "importtime", "-c", code], env=env, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE, check=True)
+    runtime = perf_counter() - started
+    imports = []
+    for line in p.stderr.decode("utf-8").splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((depth, name.strip(), int(cumulative) / 1e6))
+    return runtime, imports
+
+
+def dependencies(imports):
+    """
+    The first non-shipper module on each chain of imports with its cumulative time, i.e. what shipper's own modules
+    pulled in
+    """
+    deps = {}
+    stack = []
+    for depth, name, cumulative in reversed(imports):  # parents first
+        del stack[depth:]
+        if not name.startswith("shipper") and all(parent.startswith("shipper") for parent in stack):
+            deps[name] = max(deps.get(name, 0), cumulative)
+        stack.append(name)
+    return deps
+
+
+def bench(code, count, startup_modules):
+    importtime(code)  # compile .pyc files
+    runtimes, totals, deps, modules = [], [], {}, set()
+    for _ in range(count):
+        runtime, imports = importtime(code)
+        runtimes.append(runtime)
+        totals.append(sum(c for depth, name, c in imports if depth == 0 and name not in startup_modules))
+        for name, cumulative in dependencies(imports).items():
+            deps.setdefault(name, []).append(cumulative)
+        modules.update(name for _, name, _ in imports)
+    return {
+        "imports": statistics.median(totals),
+        "runtime": statistics.median(runtimes),
+        "deps": sorted(((statistics.median(v), k) for k, v in deps.items() if k not in startup_modules),
+                       reverse=True),
+        "modules": modules,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="import time benchmark")
+    parser.add_argument("-n", "--count", type=int, default=5, help="runs per entry point")
+    parser.add_argument("--check", action="store_true", help="fail on forbidden imports or imports over --max-ms")
+    parser.add_argument("--max-ms", type=float, help="with --check, the most an entry point's imports may take")
+    args = parser.parse_args()
+
+    _, startup = importtime("pass")
+    startup_modules = {name for _, name, _ in startup}
+    failures = []
+    for name, code, forbidden in SCENARIOS:
+        result = bench(code, args.count, startup_modules)
+        heaviest = ", ".join("{} {:.1f}ms".format(dep, t * 1000) for t, dep in result["deps"][:4])
+        print("{: <22} imports p50={:6.1f}ms  process p50={:6.1f}ms  heaviest: {}".format(
+            name, result["imports"] * 1000, result["runtime"] * 1000, heaviest))
+        for module in forbidden:
+            if module in result["modules"]:
+                failures.append("{} imports {}".format(name, module))
+        if args.max_ms and result["imports"] * 1000 > args.max_ms:
+            failures.append("{} imports took {:.1f}ms".format(name, result["imports"] * 1000))
+
+    for failure in failures:
+        print("FAIL:", failure)
+    if args.check and failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
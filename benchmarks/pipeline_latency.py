@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+End to end benchmark of the webhook to first task path - TaskWeb.index, TaskExecutor.enqueue, the worker pool, the
+runner and the job's first task - plus throughput under a storm of concurrent webhooks. Runs entirely offline: a local
+shipperd is started against a local paramiko SSH server, which runs commands on this machine, so SshTask,
+GitCheckoutTask (cloning a local bare repo over ssh) and RsyncTask (if rsync is installed) exercise their real code.
+
+Reports p50/p99 of the webhook response time, of the time from sending the webhook to the first task starting and of
+the total job runtime, and completed jobs/sec.
+
+    python benchmarks/pipeline_latency.py                      # sequential latency, then a storm of 100 webhooks
+    python benchmarks/pipeline_latency.py -n 50 --storm 500 -c 50 -- --runner warm --workers 10
+    python benchmarks/pipeline_latency.py --job noop          # only measure shipperd itself
+"""
+import os
+import sys
+import json
+import socket
+import shutil
+import argparse
+import threading
+import subprocess
+import http.client
+from tempfile import TemporaryDirectory
+from time import time, sleep
+
+import paramiko
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+JOBFILE = """
+import json
+from time import time
+from shipper.lib import ShipperJob, SshConnection, PythonTask, SshTask, GitCheckoutTask, RsyncTask
+
+def mark(job):
+    with open({marks!r}, "a") as f:
+        f.write(json.dumps({{"seq": job.props["payload"]["seq"], "start": time()}}) + "\\n")
+
+job = ShipperJob()
+job.default_connection(SshConnection("127.0.0.1", "bench", key={key!r}, port={port}))
+job.add_task(PythonTask(mark))
+if {full}:
+    job.add_task(SshTask("echo hello from the ssh stand-in"))
+    job.add_task(GitCheckoutTask("ssh://bench@127.0.0.1:{port}{repo}", "code", branch="master"))
+    if {rsync}:
+        job.add_task(RsyncTask("code/", "bench@127.0.0.1:{dest}/"))
+"""
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class LocalSshServer(paramiko.ServerInterface):
+    """
+    Accepts the given key and runs exec requests as local shell commands, piping stdin and output both ways
+    """
+    def __init__(self, pubkey):
+        self.pubkey = pubkey
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL if key == self.pubkey else paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == "session" else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.execute, args=(channel, command.decode("utf-8")), daemon=True).start()
+        return True
+
+    @staticmethod
+    def execute(channel, command):
+        # a session of its own, as sshd gives each command
+        proc = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, start_new_session=True)
+
+        def feed():
+            try:
+                while True:
+                    data = channel.recv(65536)
+                    if not data:
+                        break
+                    proc.stdin.write(data)
+                    proc.stdin.flush()
+            except (OSError, EOFError):
+                pass
+            finally:
+                try:
+                    proc.stdin.close()
+                except OSError:
+                    pass
+        threading.Thread(target=feed, daemon=True).start()
+        while True:
+            data = proc.stdout.read1(65536)
+            if not data:
+                break
+            channel.sendall(data)
+        status = proc.wait()
+        channel.send_exit_status(status if status >= 0 else 128 - status)  # killed by a signal, as a shell reports it
+        channel.shutdown_write()
+        channel.close()
+
+
+def serve_ssh(sock, hostkey, pubkey):
+    while True:
+        conn, _ = sock.accept()
+
+        def handle(conn):
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(hostkey)
+            transport.start_server(server=LocalSshServer(pubkey))
+            channels = []  # paramiko closes channels that are garbage collected
+            while transport.is_active():
+                channel = transport.accept(timeout=1)
+                if channel is not None:
+                    channels = [c for c in channels if not c.closed] + [channel]
+        threading.Thread(target=handle, args=(conn, ), daemon=True).start()
+
+
+def make_repo(path):
+    env = dict(os.environ, GIT_AUTHOR_NAME="bench", GIT_AUTHOR_EMAIL="bench@localhost", GIT_COMMITTER_NAME="bench",
+               GIT_COMMITTER_EMAIL="bench@localhost")
+    work = path + ".work"
+    subprocess.check_call(["git", "init", "-q", "-b", "master", work], env=env)
+    for i in range(20):
+        with open(os.path.join(work, "file{}.txt".format(i)), "w") as f:
+            f.write("line\n" * 1000)
+    subprocess.check_call(["git", "-C", work, "add", "."], env=env)
+    subprocess.check_call(["git", "-C", work, "commit", "-q", "-m", "initial"], env=env)
+    subprocess.check_call(["git", "clone", "-q", "--bare", work, path], env=env)
+
+
+def start_server(workdir, port, home, extra_args):
+    env = dict(os.environ, HOME=home,  # keep ssh's known_hosts out of the real home dir
+               PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+    proc = subprocess.Popen([sys.executable, "-c", "import shipper; shipper.main()", "-p", str(port), "-t", workdir,
+                             "--logs", os.path.join(workdir, "logs")] + extra_args,
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return proc
+        except OSError:
+            sleep(0.1)
+    proc.kill()
+    raise Exception("shipperd did not start")
+
+
+def trigger(port, seq, sent, accepted, jobids):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    body = json.dumps({"seq": str(seq)})
+    sent[seq] = time()
+    conn.request("POST", "/task/bench", body=body, headers={"Content-Type": "application/json"})
+    resp = conn.getresponse()
+    data = resp.read()
+    accepted[seq] = time() - sent[seq]
+    if resp.status != 202:
+        raise Exception("webhook failed with {}: {}".format(resp.status, data[:200]))
+    jobids[seq] = json.loads(data)["id"]
+    conn.close()
+
+
+def wait_for_jobs(port, jobids, timeout=600):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    deadline = time() + timeout
+    pending = set(jobids.values())
+    jobs = {}
+    while pending and time() < deadline:
+        conn.request("GET", "/job/?limit={}".format(len(jobids) + 100))
+        for job in json.loads(conn.getresponse().read()):
+            if job["id"] in pending and job["finished"]:
+                pending.discard(job["id"])
+                jobs[job["id"]] = job
+        if pending:
+            sleep(0.1)
+    conn.close()
+    if pending:
+        raise Exception("{} jobs did not finish".format(len(pending)))
+    return jobs
+
+
+def run_batch(port, seqs, clients, marks, wait_each=False):
+    """
+    Trigger a job for each of `seqs` from `clients` concurrent clients, optionally waiting for every job to finish
+    before triggering the next one, and collect the timings once all of them are done
+    """
+    sent, accepted, jobids = {}, {}, {}
+    todo = list(seqs)
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                if not todo:
+                    return
+                seq = todo.pop(0)
+            trigger(port, seq, sent, accepted, jobids)
+            if wait_each:
+                wait_for_jobs(port, {seq: jobids[seq]})
+
+    start = time()
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    jobs = wait_for_jobs(port, jobids)
+    elapsed = time() - start
+
+    starts = {}
+    with open(marks) as f:
+        for line in f:
+            mark = json.loads(line)
+            starts[int(mark["seq"])] = mark["start"]
+    failed = [job for job in jobs.values() if job["state"] != "succeeded"]
+    return {
+        "accept": [accepted[s] for s in seqs],
+        "first_task": [starts[s] - sent[s] for s in seqs if s in starts],
+        "duration": [job["duration"] for job in jobs.values()],
+        "failed": len(failed),
+        "elapsed": elapsed,
+    }
+
+
+def report(name, result):
+    print("{}: {} jobs in {:.2f}s, {:.1f} jobs/s, {} failed".format(
+        name, len(result["accept"]), result["elapsed"], len(result["accept"]) / result["elapsed"], result["failed"]))
+    for label, key in (("webhook response", "accept"), ("webhook -> first task", "first_task"),
+                       ("job runtime", "duration")):
+        values = result[key]
+        if values:
+            print("  {: <22} p50={:8.1f}ms  p99={:8.1f}ms  max={:8.1f}ms".format(
+                label, percentile(values, 50) * 1000, percentile(values, 99) * 1000, max(values) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="webhook to first task latency benchmark")
+    parser.add_argument("-n", "--count", type=int, default=20, help="jobs to trigger one at a time")
+    parser.add_argument("--storm", type=int, default=100, help="jobs to trigger concurrently")
+    parser.add_argument("-c", "--clients", type=int, default=20, help="concurrent clients during the storm")
+    parser.add_argument("--job", choices=["full", "noop"], default="full",
+                        help="run ssh, git and rsync tasks after the first one, or nothing")
+    parser.add_argument("-p", "--port", type=int, default=18081, help="port for the local shipperd")
+    parser.add_argument("server_args", nargs="*", help="extra shipperd arguments, after --")
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as d:
+        keyfile = os.path.join(d, "id_rsa")
+        userkey = paramiko.RSAKey.generate(2048)
+        userkey.write_private_key_file(keyfile)
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(100)
+        threading.Thread(target=serve_ssh, args=(sock, paramiko.RSAKey.generate(2048), userkey), daemon=True).start()
+
+        repo = os.path.join(d, "repo.git")
+        make_repo(repo)
+        rsync = shutil.which("rsync") is not None
+        if args.job == "full" and not rsync:
+            print("rsync is not installed, leaving out the RsyncTask")
+        os.makedirs(os.path.join(d, "home"))
+        marks = os.path.join(d, "marks.jsonl")
+        with open(os.path.join(d, "bench.py"), "w") as f:
+            f.write(JOBFILE.format(marks=marks, key=keyfile, port=sock.getsockname()[1], repo=repo,
+                                   dest=os.path.join(d, "dest"), full=args.job == "full", rsync=rsync))
+
+        proc = start_server(d, args.port, os.path.join(d, "home"), args.server_args)
+        try:
+            run_batch(args.port, [0], 1, marks, wait_each=True)  # warm up
+            if args.count:
+                report("sequential", run_batch(args.port, range(1, args.count + 1), 1, marks, wait_each=True))
+            if args.storm:
+                first = args.count + 1
+                report("storm ({} clients)".format(args.clients),
+                       run_batch(args.port, range(first, first + args.storm), args.clients, marks))
+        finally:
+            proc.terminate()
+            proc.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Job queue scheduling simulation. Feeds a mix of slow builds and quick hotfix deploys through the real job queue with
+sleeping workers, once with a single FIFO lane and once with a high priority hotfix lane, and reports queue wait
+percentiles per kind of job. Durations are in milliseconds of wall time.
+
+    python benchmarks/queue_sim.py
+    python benchmarks/queue_sim.py --workers 2 --builds 40 --hotfixes 20
+"""
+import os
+import sys
+import random
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from threading import Semaphore, Thread
+from time import sleep, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shipper.jobqueue import Lane, MemoryJobQueue, QueuedJob  # NOQA
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def simulate(q, jobs, workers):
+    """
+    Submit `jobs` - (delay, QueuedJob, duration) tuples - to queue `q` and run them with `workers` workers. Returns
+    the finished jobs.
+    """
+    done = []
+    slots = Semaphore(workers)
+
+    def work(job, duration):
+        sleep(duration)
+        q.finish(job, 0)
+        done.append(job)
+        slots.release()
+
+    def submit():
+        start = time()
+        for delay, job, duration in jobs:
+            sleep(max(0, start + delay - time()))
+            job.queued = time()
+            q.put(job)
+
+    durations = {job.id: duration for _, job, duration in jobs}
+    feeder = Thread(target=submit, daemon=True)
+    feeder.start()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for _ in jobs:
+            slots.acquire()
+            job = q.get()
+            pool.submit(work, job, durations[job.id])
+    feeder.join()
+    return done
+
+
+def workload(args, seed):
+    rnd = random.Random(seed)
+    jobs = []
+    for i in range(args.builds):
+        jobs.append((rnd.uniform(0, args.span / 1000), "build", args.build_ms / 1000 * rnd.uniform(0.5, 1.5)))
+    for i in range(args.hotfixes):
+        jobs.append((rnd.uniform(0, args.span / 1000), "hotfix", args.hotfix_ms / 1000 * rnd.uniform(0.5, 1.5)))
+    return sorted(jobs, key=lambda j: j[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare FIFO and laned job scheduling")
+    parser.add_argument("--workers", default=3, type=int)
+    parser.add_argument("--builds", default=30, type=int, help="number of slow build jobs")
+    parser.add_argument("--hotfixes", default=15, type=int, help="number of quick hotfix jobs")
+    parser.add_argument("--build-ms", default=200, type=int, help="mean build duration")
+    parser.add_argument("--hotfix-ms", default=10, type=int, help="mean hotfix duration")
+    parser.add_argument("--span", default=1000, type=int, help="jobs are submitted over this many ms")
+    parser.add_argument("--build-limit", default=0, type=int,
+                        help="max concurrent builds in the laned run, reserving the rest of the workers")
+    parser.add_argument("--seed", default=1, type=int)
+    args = parser.parse_args()
+
+    setups = [
+        ("fifo", [], lambda kind: QueuedJob(kind, {})),
+        ("lanes", [Lane("hotfix", 10), Lane("build", 0, args.build_limit)],
+         lambda kind: QueuedJob(kind, {}, lane=kind)),
+    ]
+    print("{:<6} {:<7} {:>5} {:>10} {:>10} {:>10}".format("queue", "kind", "jobs", "wait p50", "wait p99", "total"))
+    for name, lanes, make in setups:
+        jobs = [(delay, make(kind), duration) for delay, kind, duration in workload(args, args.seed)]
+        q = MemoryJobQueue(lanes=lanes)
+        start = time()
+        done = simulate(q, jobs, args.workers)
+        total = time() - start
+        for kind in ("build", "hotfix"):
+            waits = [(j.started - j.queued) * 1000 for j in done if j.name == kind]
+            print("{:<6} {:<7} {:>5} {:>8.1f}ms {:>8.1f}ms {:>9.2f}s".format(
+                name, kind, len(waits), percentile(waits, 50), percentile(waits, 99), total))
+
+
+if __name__ == "__main__":
+    main()
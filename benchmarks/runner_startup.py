@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Compare job startup latency of the spawn and warm runner backends.
+
+    python benchmarks/runner_startup.py -n 20
+"""
+import os
+import sys
+import argparse
+import statistics
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")]))
+
+from shipper import QueuedJob  # NOQA
+from shipper.runners import SpawnRunner, WarmRunner  # NOQA
+
+JOBFILE = """
+from shipper.lib import ShipperJob, PythonTask
+
+job = ShipperJob()
+job.add_task(PythonTask(lambda job: None))
+"""
+
+
+def bench(runner, count):
+    times = []
+    for _ in range(count):
+        start = perf_counter()
+        assert runner.run(QueuedJob("noop", {})) == 0
+        times.append(perf_counter() - start)
+    return times
+
+
+def report(name, times):
+    times = sorted(times)
+    print("{: <6} n={} mean={:.1f}ms p50={:.1f}ms max={:.1f}ms".format(
+        name, len(times), statistics.mean(times) * 1000, statistics.median(times) * 1000, times[-1] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="runner startup benchmark")
+    parser.add_argument("-n", "--count", type=int, default=20)
+    args = parser.parse_args()
+
+    runnerpath = os.path.join(ROOT, "shipper", "runjob.py")
+    with TemporaryDirectory() as d:
+        os.chdir(d)
+        with open("noop.py", "w") as f:
+            f.write(JOBFILE)
+
+        report("spawn", bench(SpawnRunner(runnerpath), args.count))
+
+        warm = WarmRunner(runnerpath, size=1)
+        try:
+            bench(warm, 1)  # wait for the runner to finish preloading
+            report("warm", bench(warm, args.count))
+        finally:
+            warm.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Webhook load test. Fires POST requests at a task endpoint from many concurrent clients and reports requests/sec and
+latency percentiles. Without --url, a local shipperd is started with a no-op job to test against.
+
+    python benchmarks/webhook_load.py -c 50 -d 10
+    python benchmarks/webhook_load.py --url http://host:8080/task/foo -c 20
+"""
+import os
+import sys
+import json
+import socket
+import argparse
+import subprocess
+import http.client
+from collections import Counter
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import perf_counter, sleep
+from urllib.parse import urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+JOBFILE = """
+from shipper.lib import ShipperJob, PythonTask
+
+job = ShipperJob()
+job.add_task(PythonTask(lambda job: None))
+"""
+
+PAYLOAD = json.dumps({"ref": "refs/heads/master", "repository": {"name": "bench"},
+                      "commits": [{"id": "0" * 40, "message": "x" * 200}] * 20}).encode()
+
+
+def percentile(values, pct):
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def client(url, deadline, latencies, statuses):
+    conn = None
+    while perf_counter() < deadline:
+        if conn is None:
+            conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+        start = perf_counter()
+        try:
+            conn.request("POST", url.path, body=PAYLOAD, headers={"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            resp.read()
+            statuses[resp.status] += 1
+        except (OSError, http.client.HTTPException) as e:
+            statuses[type(e).__name__] += 1
+            conn.close()
+            conn = None
+            continue
+        latencies.append(perf_counter() - start)
+
+
+def start_server(workdir, port, extra_args):
+    with open(os.path.join(workdir, "noop.py"), "w") as f:
+        f.write(JOBFILE)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+    proc = subprocess.Popen([sys.executable, "-c", "import shipper; shipper.main()", "-p", str(port), "-t", workdir]
+                            + extra_args, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return proc
+        except OSError:
+            sleep(0.1)
+    proc.kill()
+    raise Exception("shipperd did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="webhook load test")
+    parser.add_argument("--url", help="task url to hit (default: start a local shipperd)")
+    parser.add_argument("-c", "--clients", type=int, default=20, help="concurrent clients")
+    parser.add_argument("-d", "--duration", type=float, default=5, help="seconds to run for")
+    parser.add_argument("-p", "--port", type=int, default=18080, help="port for the local shipperd")
+    parser.add_argument("server_args", nargs="*", help="extra shipperd arguments, after --")
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as d:
+        proc = None
+        url = args.url
+        if not url:
+            proc = start_server(d, args.port, args.server_args)
+            url = "http://127.0.0.1:{}/task/noop".format(args.port)
+        try:
+            latencies = []
+            statuses = Counter()
+            deadline = perf_counter() + args.duration
+            threads = [Thread(target=client, args=(urlparse(url), deadline, latencies, statuses))
+                       for _ in range(args.clients)]
+            start = perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = perf_counter() - start
+        finally:
+            if proc:
+                proc.terminate()
+                proc.wait()
+
+    latencies.sort()
+    print("requests: {}  statuses: {}".format(len(latencies), dict(statuses)))
+    if latencies:
+        print("{:.1f} req/s  p50={:.1f}ms  p99={:.1f}ms  max={:.1f}ms".format(
+            len(latencies) / elapsed, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+            latencies[-1] * 1000))
+
+
+if __name__ == '__main__':
+    main()
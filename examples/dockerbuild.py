@@ -5,6 +5,12 @@ from shipper.lib import ShipperJob, SshConnection, GiteaCheckoutTask, LambdaTask
 # This job accepts gitea webooks and builds docker images. If the "imagename" parameter is passed, it will be used to
 # name the image. Otherwise, a repo named "docker-image-name" would builds/pushes a docker image called "image-name".
 
+# Pushes arriving in quick succession are collapsed: a queued build of the same branch is dropped when a newer push
+# arrives, builds wait 10 seconds for further pushes before starting, and only one build of this job runs at a time.
+coalesce = "latest"
+debounce = 10
+concurrency = 1
+
 
 job = ShipperJob()
 job.default_connection(SshConnection(None, None, key="testkey.pem"))
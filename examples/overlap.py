@@ -0,0 +1,28 @@
+import asyncio
+from shipper.lib import ShipperJob, SshConnection, GitCheckoutTask, DockerBuildTask, DockerPushTask, RsyncTask, \
+    SshTask, PythonTask
+
+
+job = ShipperJob()
+job.default_connection(SshConnection("10.0.0.1", "deploy", key="keyfile.pem"))
+
+job.add_task(GitCheckoutTask("ssh://git@git.davepedu.com:223/dave/shipper.git", "code", branch="master"))
+
+# The image is built while the static files are uploaded; the push waits for the build to finish.
+build = DockerBuildTask("registry:5000/shipper:latest", codedir="code")
+job.add_task(build, overlap=True)
+job.add_task(RsyncTask("./code/static/", "deploy@10.0.0.1:/var/www/static/"), timeout=300)
+job.add_task(DockerPushTask("registry:5000/shipper:latest"), after=[build])
+
+
+async def wait_for_healthy(job):
+    for _ in range(30):
+        proc = await asyncio.create_subprocess_exec("curl", "-sf", "http://10.0.0.1/health")
+        if await proc.wait() == 0:
+            return
+        await asyncio.sleep(2)
+    raise Exception("app did not become healthy")
+
+
+job.add_task(SshTask("docker pull registry:5000/shipper:latest && systemctl restart app"))
+job.add_task(PythonTask(wait_for_healthy), timeout=90)
@@ -0,0 +1,15 @@
+from shipper.lib import ShipperJob, SshConnection, GitCheckoutTask, RsyncTask, SshTask, ParallelTask, SerialTask
+
+
+job = ShipperJob()
+
+hosts = [SshConnection("10.0.0.{}".format(i), "deploy", key="keyfile.pem") for i in range(1, 13)]
+job.default_connection(hosts[0])
+
+job.add_task(GitCheckoutTask("ssh://git@git.davepedu.com:223/dave/shipper.git", "code", branch="master"))
+
+# ParallelTask runs its tasks concurrently, here at most 6 hosts at a time. SerialTask groups steps that must happen in
+# order on a single host. The job moves on once every host is done and fails if any of them failed.
+job.add_task(ParallelTask([SerialTask([RsyncTask("./code/", "deploy@{}:/opt/app/".format(conn.host), connection=conn),
+                                       SshTask("systemctl restart app", connection=conn)])
+                           for conn in hosts], max_workers=6))
@@ -0,0 +1,15 @@
+from shipper.lib import ShipperJob, SshConnection, SshTask
+
+
+# Run this job every night at 03:30 (server local time) in addition to whenever it is triggered over HTTP. A number of
+# seconds may be given instead, e.g. `schedule = 600` for every 10 minutes. A scheduled run is skipped if the previous
+# one hasn't finished yet.
+schedule = "30 3 * * *"
+
+# If the server was down at 03:30, run once when it comes back rather than waiting for the next night. "skip" (the
+# default) waits; "all" would run once for every missed night.
+catchup = "once"
+
+job = ShipperJob()
+job.default_connection(SshConnection("192.168.1.60", "root", key="testkey.pem"))
+job.add_task(SshTask("find /var/backups -mtime +30 -delete"))
@@ -0,0 +1,23 @@
+from shipper.lib import ShipperJob, SshConnection, ScriptTask
+
+
+job = ShipperJob()
+job.default_connection(SshConnection("192.168.1.60", "deploy", key="keyfile.pem"))
+
+# ScriptTask uploads its commands as one script and runs it with a single command, rather than a round trip per SshTask.
+# The commands run in the same shell, so the `cd` applies to the rest. It stops at the first failing command, which is
+# reported along with its exit status; the output of each command is logged under it.
+job.add_task(ScriptTask(["cd /opt/app",
+                         "git pull --ff-only",
+                         "./venv/bin/pip install -r requirements.txt",
+                         "sudo systemctl restart app"]))
+
+# A whole script can be given too, run with its #! line or /bin/sh
+job.add_task(ScriptTask("""#!/bin/bash
+set -e
+for i in $(seq 1 10); do
+    curl -fs http://localhost:8080/health && exit 0
+    sleep 1
+done
+exit 1
+"""))
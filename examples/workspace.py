@@ -0,0 +1,23 @@
+from shipper.lib import ShipperJob, SshConnection, GitCheckoutTask, CmdTask, PythonTask
+
+
+# Keep the job's working directory between runs. The checkout below is updated in place rather than cloned again, and
+# build outputs left in the directory are there next time. Concurrent runs of this job wait for each other.
+workspace = "persistent"
+
+job = ShipperJob()
+job.default_connection(SshConnection(None, None, key="testkey.pem"))
+job.add_task(GitCheckoutTask("ssh://git@git.davepedu.com:223/dave/someapp.git", "code", branch="master", cache=True))
+
+
+# The artifact cache stores directories under a key, shared by all jobs on this machine and limited in size (see
+# $SHIPPER_ARTIFACT_CACHE_SIZE). Keying on the lockfile means dependencies are only installed when it changes.
+def install_deps(job):
+    key = job.cache_key("node_modules", "code/package-lock.json")
+    if not job.restore_cache(key, "code/node_modules"):
+        CmdTask("cd code && npm ci").run(job)
+        job.save_cache(key, "code/node_modules")
+
+
+job.add_task(PythonTask(install_deps))
+job.add_task(CmdTask("cd code && npm run build"))
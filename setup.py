@@ -12,8 +12,9 @@ setup(name='shipper',
       url='http://git.davepedu.com/dave/shipper',
       author='dpedu',
       author_email='dave@davepedu.com',
-      packages=['shipper'],
+      packages=['shipper', 'shipper.lib'],
       install_requires=reqs,
+      python_requires=">=3.8",
       entry_points={
           "console_scripts": [
               "shipperd = shipper:main",
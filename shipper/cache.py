@@ -0,0 +1,125 @@
+import os
+import fcntl
+import shutil
+import hashlib
+from contextlib import contextmanager
+from tempfile import mkdtemp
+from time import time
+
+
+def cache_dir(*parts):
+    """
+    Return (and create) a directory under the shared on-disk cache, $SHIPPER_CACHE_DIR or ~/.cache/shipper
+    """
+    base = os.environ.get("SHIPPER_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "shipper")
+    path = os.path.join(base, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+@contextmanager
+def locked(path):
+    """
+    Hold an exclusive flock() on `path` - shared by all jobs and processes on this machine
+    """
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def hash_files(*paths):
+    """
+    Return a digest of the contents of `paths`, e.g. lockfiles, for use as an artifact cache key
+    """
+    h = hashlib.sha256()
+    for path in paths:
+        h.update(path.encode("utf-8") + b"\0")
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def tree_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class ArtifactCache(object):
+    """
+    Directories cached by key, shared by all jobs on this machine. The total size is kept under `max_bytes` by
+    evicting the least recently used entries.
+    """
+    def __init__(self, root=None, max_bytes=None):
+        self.root = root or cache_dir("artifacts")
+        self.max_bytes = max_bytes or int(os.environ.get("SHIPPER_ARTIFACT_CACHE_SIZE", 5 * 1024 ** 3))
+        self.lockfile = os.path.join(self.root, ".lock")
+
+    def entry(self, key):
+        return os.path.join(self.root, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def restore(self, key, dest):
+        """
+        Copy the directory cached under `key` to `dest`. Returns False if there is no such entry.
+        """
+        entry = self.entry(key)
+        with locked(self.lockfile):
+            if not os.path.isdir(os.path.join(entry, "data")):
+                return False
+            os.utime(entry)  # mark as recently used
+            shutil.copytree(os.path.join(entry, "data"), dest, symlinks=True, dirs_exist_ok=True)
+        return True
+
+    def save(self, key, src):
+        """
+        Store a copy of directory `src` under `key`, unless an entry for it already exists
+        """
+        entry = self.entry(key)
+        if os.path.isdir(entry):
+            return
+        tmp = mkdtemp(prefix=".tmp-", dir=self.root)
+        try:
+            shutil.copytree(src, os.path.join(tmp, "data"), symlinks=True)
+            with open(os.path.join(tmp, "size"), "w") as f:
+                f.write(str(tree_size(tmp)))
+            with locked(self.lockfile):
+                if os.path.isdir(entry):
+                    return
+                os.rename(tmp, entry)
+                tmp = None
+                self.evict()
+        finally:
+            if tmp:
+                shutil.rmtree(tmp, ignore_errors=True)
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_bytes. Called with the lock held.
+        """
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+            try:
+                with open(os.path.join(path, "size")) as f:
+                    size = int(f.read())
+            except (OSError, ValueError):
+                size = tree_size(path)
+            entries.append((os.path.getmtime(path), size, path))
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            print("Evicting cache entry {} ({} bytes, last used {:.0f}s ago)".format(path, size, time() - mtime))
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
@@ -0,0 +1,287 @@
+import os
+import json
+import socket
+import traceback
+import urllib.request
+from threading import Thread, Lock, Event
+from time import time
+from shipper.jobqueue import QueuedJob, RUNNING, SUCCEEDED, FAILED, CANCELLED
+
+
+class Lease(object):
+    def __init__(self, job, worker, ttl, log_base=0, confirm_within=5):
+        self.job = job
+        self.worker = worker
+        self.ttl = ttl
+        self.log_base = log_base  # where this attempt's output starts in the log, after that of expired attempts
+        # until the worker's first heartbeat confirms it got the job, e.g. the lease wasn't handed to a worker that died
+        # while long-polling, the lease is short
+        self.expires = time() + min(ttl, confirm_within)
+        self.cancel = False
+
+    def renew(self):
+        self.expires = time() + self.ttl
+
+
+class Coordinator(object):
+    """
+    Hands jobs from the queue out to worker nodes. A worker leases a job, keeps the lease alive with heartbeats while it
+    runs, streams the job's log back and reports the result. Jobs whose lease expires, because the worker died or lost
+    its connection, are put back on the queue for another worker.
+
+    Used as the TaskExecutor's runner in coordinator mode, so cancelling a job works as it does for local jobs: the kill
+    is relayed to the worker in its next heartbeat.
+    """
+    def __init__(self, lease_ttl=30):
+        self.lease_ttl = lease_ttl
+        self.executor = None
+        self.leases = {}
+        self.lock = Lock()
+        self.stopped = Event()
+        self.reaper = Thread(target=self.expire_loop, daemon=True)
+        self.reaper.start()
+
+    def lease(self, worker, labels, wait=10):
+        """
+        Wait up to `wait` seconds for a job that `worker`, having `labels`, may run and lease it to the worker
+        """
+        job = self.executor.q.get(frozenset(labels), timeout=wait)
+        if job is None:
+            return None
+        try:
+            log_base = os.path.getsize(self.executor.logpath(job))
+        except (OSError, TypeError):
+            log_base = 0
+        with self.lock:
+            self.leases[job.id] = Lease(job, worker, self.lease_ttl, log_base)
+        print("Leased {} ({}) to worker {}".format(job.id, job.name, worker))
+        return job
+
+    def get_lease(self, worker, jobid):
+        with self.lock:
+            lease = self.leases.get(jobid)
+        if lease is None or lease.worker != worker:
+            return None
+        return lease
+
+    def heartbeat(self, worker, jobids):
+        """
+        Renew the worker's leases. Returns the ids of the jobs the worker should kill: cancelled ones, and ones it no
+        longer holds the lease for.
+        """
+        kill = []
+        for jobid in jobids:
+            lease = self.get_lease(worker, jobid)
+            if lease is None:
+                kill.append(jobid)
+                continue
+            lease.renew()
+            if lease.cancel:
+                kill.append(jobid)
+        return kill
+
+    def append_log(self, worker, jobid, offset, data):
+        """
+        Append output of a leased job to its log, starting at byte `offset`. Resent data is skipped, so chunks can be
+        retried safely. Returns the log's new size.
+        """
+        lease = self.get_lease(worker, jobid)
+        if lease is None:
+            return None
+        offset += lease.log_base
+        with open(self.executor.logpath(lease.job), "ab") as f:
+            size = f.tell()
+            if offset > size:
+                raise ValueError("log offset {} is past the end of the log ({} bytes)".format(offset, size))
+            f.write(data[size - offset:])
+            return f.tell()
+
+    def finish(self, worker, jobid, returncode, state=None, stats=None):
+        with self.lock:
+            lease = self.leases.get(jobid)
+            if lease is None or lease.worker != worker:
+                return None
+            del self.leases[jobid]
+        if stats is not None:
+            with open(self.executor.statspath(lease.job), "w") as f:
+                json.dump(stats, f)
+        self.executor.complete(lease.job, returncode, state)
+        print("Worker {} finished {}".format(worker, jobid))
+        return lease.job
+
+    def kill(self, job):
+        with self.lock:
+            lease = self.leases.get(job.id)
+        if lease is None:
+            return False
+        lease.cancel = True
+        return True
+
+    def expire_loop(self, interval=1):
+        while not self.stopped.wait(interval):
+            now = time()
+            with self.lock:
+                expired = [lease for lease in self.leases.values() if lease.expires < now]
+                for lease in expired:
+                    del self.leases[lease.job.id]
+            for lease in expired:
+                print("Lease on {} held by worker {} expired, requeueing".format(lease.job.id, lease.worker))
+                self.executor.q.requeue(lease.job)
+
+    def close(self):
+        self.stopped.set()
+
+
+class CoordinatorClient(object):
+    """
+    Calls the coordinator's /worker API
+    """
+    def __init__(self, url, token=None, timeout=60):
+        self.url = url.rstrip("/")
+        self.token = token
+        self.timeout = timeout
+
+    def call(self, method, body=None, query="", raw=None):
+        headers = {}
+        if self.token:
+            headers["Authorization"] = "Bearer " + self.token
+        if raw is not None:
+            data = raw
+            headers["Content-Type"] = "application/octet-stream"
+        else:
+            data = json.dumps(body or {}).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        req = urllib.request.Request("{}/worker/{}{}".format(self.url, method, query), data=data, headers=headers)
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            if resp.status == 204:
+                return None
+            return json.loads(resp.read())
+
+
+class RemoteJobQueue(object):
+    """
+    Worker side of the coordinator protocol, standing in for the job queue of a worker node's TaskExecutor: get()
+    leases a job from the coordinator and finish() reports the result. While jobs run their logs are shipped to the
+    coordinator and their leases renewed in the background.
+    """
+    def __init__(self, client, worker=None, heartbeat_interval=5, ship_interval=1, poll_wait=10):
+        self.client = client
+        self.worker = worker or "{}-{}".format(socket.gethostname(), os.getpid())
+        self.heartbeat_interval = heartbeat_interval
+        self.ship_interval = ship_interval
+        self.poll_wait = poll_wait
+        self.executor = None
+        self.next_heartbeat = 0
+        self.active = {}  # job id -> [job, log offset]
+        self.lock = Lock()
+        self.stopped = Event()
+        Thread(target=self.heartbeat_loop, daemon=True).start()
+        Thread(target=self.ship_loop, daemon=True).start()
+
+    def get(self, labels=None, timeout=None):
+        while True:
+            try:
+                msg = self.client.call("lease", {"worker": self.worker, "labels": sorted(labels or ()),
+                                                 "wait": self.poll_wait})
+            except (OSError, ValueError) as e:
+                print("Could not lease a job from the coordinator: {}".format(e))
+                self.stopped.wait(5)
+                continue
+            if msg is None:
+                continue
+            job = QueuedJob(msg["name"], msg["args"], id=msg["id"], state=RUNNING, queued=msg["queued"],
+                            timeout=msg["timeout"], resume_from=msg["resume_from"])
+            job.started = time()
+            with self.lock:
+                self.active[job.id] = [job, 0]
+                # heartbeat often enough that a lost beat or two doesn't cost the lease
+                self.heartbeat_interval = min(self.heartbeat_interval, msg["lease_ttl"] / 3)
+                self.next_heartbeat = 0  # confirm the lease right away
+            print("Leased {} ({})".format(job.id, job.name))
+            return job
+
+    def finish(self, job, returncode, state=None):
+        self.ship(job.id)
+        with self.lock:
+            del self.active[job.id]
+        job.returncode = returncode
+        job.state = state or (SUCCEEDED if returncode == 0 else FAILED)
+        job.finished = time()
+        stats = None
+        try:
+            with open(self.executor.statspath(job)) as f:
+                stats = json.load(f)
+        except (OSError, ValueError):
+            pass
+        try:
+            self.client.call("finish", {"worker": self.worker, "job": job.id, "returncode": returncode,
+                                        "state": state, "stats": stats})
+        except (OSError, ValueError) as e:
+            # the lease will expire and the job will be run again elsewhere
+            print("Could not report the result of {}: {}".format(job.id, e))
+
+    def ship(self, jobid):
+        """
+        Send new output from the job's log file to the coordinator
+        """
+        with self.lock:
+            entry = self.active.get(jobid)
+        if entry is None:
+            return
+        job, offset = entry
+        path = self.executor.logpath(job)
+        try:
+            with open(path, "rb") as f:
+                f.seek(offset)
+                while True:
+                    data = f.read(256 * 1024)
+                    if not data:
+                        break
+                    self.client.call("log", raw=data, query="?worker={}&job={}&offset={}".format(
+                        self.worker, job.id, offset))
+                    offset += len(data)
+                    entry[1] = offset
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print("Could not ship the log of {}: {}".format(job.id, e))
+
+    def ship_loop(self):
+        while not self.stopped.wait(self.ship_interval):
+            with self.lock:
+                jobids = list(self.active)
+            for jobid in jobids:
+                self.ship(jobid)
+
+    def heartbeat_loop(self):
+        while not self.stopped.wait(0.5):
+            if time() < self.next_heartbeat:
+                continue
+            self.next_heartbeat = time() + self.heartbeat_interval
+            with self.lock:
+                jobs = {jobid: entry[0] for jobid, entry in self.active.items()}
+            if not jobs:
+                continue
+            try:
+                msg = self.client.call("heartbeat", {"worker": self.worker, "jobs": list(jobs)})
+            except (OSError, ValueError) as e:
+                print("Heartbeat failed: {}".format(e))
+                continue
+            for jobid in msg.get("kill", []):
+                if jobid in jobs:
+                    print("Coordinator asked to kill {}".format(jobid))
+                    try:
+                        self.executor.kill(jobs[jobid], CANCELLED)
+                    except Exception:
+                        traceback.print_exc()
+
+    def depth(self):
+        return 0
+
+    def unfinished(self):
+        with self.lock:
+            return set(self.active)
+
+    def close(self):
+        self.stopped.set()
+
@@ -0,0 +1,243 @@
+import os
+import io
+import sys
+import json
+import gzip
+import shutil
+from contextvars import ContextVar
+from threading import Thread, Condition, Lock
+from time import time, perf_counter
+
+# the tasks, innermost last, being run by the current thread or asyncio task, which output is attributed to
+current_tasks = ContextVar("current_tasks", default=())
+
+
+class JobLog(object):
+    """
+    A job's log. Output and progress messages go to the job's text log (`textfd`, the log file served at
+    /job/<id>/log) and, with `eventsfile`, to a stream of structured events: the job's start and end, the start and end
+    of every task attempt with its duration and outcome, and output, tagged with the task that produced it. Events are
+    compact JSON lines, gzipped if `eventsfile` ends in ".gz".
+
+    Both are buffered and written out in batches by a background thread every `flush_interval` seconds, so tasks don't
+    wait on the disk for every line they print. At most about `max_buffer` bytes are held; a write that would exceed
+    that writes the buffer out itself.
+
+    Without `textfd`, output is written straight to sys.stdout and nothing is buffered, which is what a ShipperJob gets
+    outside of the runner.
+    """
+    def __init__(self, eventsfile=None, textfd=None, flush_interval=0.2, max_buffer=1024 * 1024):
+        self.textfd = textfd
+        self.events = None
+        if eventsfile:
+            self.events = gzip.open(eventsfile, "ab") if eventsfile.endswith(".gz") else open(eventsfile, "ab")
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.started = perf_counter()
+        self.text = []
+        self.pending = []
+        self.buffered = 0
+        self.cond = Condition()
+        self.write_lock = Lock()  # held while a batch is written, so batches land in order
+        self.closed = False
+        self.thread = None
+        if textfd is not None or self.events:
+            self.emit("job", start=time(), pid=os.getpid())
+            self.thread = Thread(target=self.write_loop, daemon=True)
+            self.thread.start()
+
+    @staticmethod
+    def current_task():
+        stack = current_tasks.get()
+        return stack[-1] if stack else None
+
+    def task_start(self, task, attempt=1):
+        """
+        Mark the start of an attempt at `task` in this thread or asyncio task; output written until task_end() is
+        tagged with it
+        """
+        current_tasks.set(current_tasks.get() + (str(task), ))
+        self.emit("start", task=str(task), cls=type(task).__name__, attempt=attempt)
+        # commands the task runs write to the text log directly, make sure they come after what was printed so far
+        self.flush()
+
+    def task_end(self, task, timing):
+        self.emit("end", task=str(task), attempt=timing["attempt"], ok=timing["ok"],
+                  duration=round(timing["duration"], 4))
+        stack = current_tasks.get()
+        if stack:
+            current_tasks.set(stack[:-1])
+
+    def info(self, msg, task=None):
+        self.write(msg + "\n", task)
+
+    def write(self, text, task=None):
+        """
+        Write output produced by `task`, by default the task this thread or asyncio task is running
+        """
+        if not text:
+            return
+        if self.thread is None:
+            self.stdout().write(text)
+            return
+        task = str(task) if task is not None else self.current_task()
+        with self.cond:
+            self.text.append(text)
+            last = self.pending[-1] if self.pending else None
+            if self.events is None:
+                pass
+            elif last and last["ev"] == "out" and last.get("task") == task:
+                last["text"] += text  # merge consecutive output of the same task into one event
+            else:
+                self.pending.append(self.event("out", task=task, text=text))
+            self.buffered += len(text)
+            full = self.buffered >= self.max_buffer
+        if full:
+            self.flush()
+
+    def emit(self, ev, **fields):
+        if self.events is None:
+            return
+        with self.cond:
+            self.pending.append(self.event(ev, **fields))
+
+    def event(self, ev, **fields):
+        event = {"t": round(perf_counter() - self.started, 4), "ev": ev}
+        event.update((k, v) for k, v in fields.items() if v is not None)
+        return event
+
+    def flush(self):
+        """
+        Write out everything buffered so far
+        """
+        with self.write_lock:
+            with self.cond:
+                text, self.text = self.text, []
+                pending, self.pending = self.pending, []
+                self.buffered = 0
+            if text and self.textfd is not None:
+                data = "".join(text).encode("utf-8", "replace")
+                while data:
+                    data = data[os.write(self.textfd, data):]
+            if pending and self.events:
+                self.events.write("".join(json.dumps(e, separators=(",", ":")) + "\n"
+                                          for e in pending).encode("utf-8"))
+                self.events.flush()  # a sync flush for gzip, so the file can be read while the job runs
+
+    def write_loop(self):
+        while True:
+            with self.cond:
+                if not self.closed:
+                    self.cond.wait(self.flush_interval)
+                closed = self.closed
+            self.flush()
+            if closed:
+                return
+
+    def stream(self):
+        """
+        A file object writing to this log, to stand in for sys.stdout and sys.stderr
+        """
+        return LogStream(self)
+
+    @staticmethod
+    def stdout():
+        return sys.__stdout__ if isinstance(sys.stdout, LogStream) else sys.stdout
+
+    def close(self, error=None):
+        if self.thread is None:
+            return
+        self.emit("job_end", ok=error is None,
+                  error="{}: {}".format(type(error).__name__, error) if error is not None else None)
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        if self.events:
+            self.events.close()
+
+
+class LogStream(io.TextIOBase):
+    """
+    File object writing to a JobLog, e.g. for print() calls in job files. flush() writes out the log's buffer, as does
+    fileno(), which is the text log's, for code handing sys.stdout to a subprocess.
+    """
+    def __init__(self, log):
+        self.log = log
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.log.write(text)
+        return len(text)
+
+    def flush(self):
+        self.log.flush()
+
+    def fileno(self):
+        if self.log.textfd is None:
+            raise io.UnsupportedOperation("fileno")
+        self.log.flush()
+        return self.log.textfd
+
+
+def read_events(path):
+    """
+    Yield the events in a job's events file. Files of running jobs may end in a partial line or gzip block, which is
+    ignored.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        try:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    return
+        except (EOFError, OSError):
+            return
+
+
+LOG_SUFFIXES = (".log", ".events", ".events.gz", ".stats.json", ".state")
+
+
+def prune_logs(logdir, max_age=None, max_bytes=None, keep=()):
+    """
+    Delete the logs, events, stats and resume state of old jobs from `logdir`: those last written to more than
+    `max_age` seconds ago, then the oldest until the files take up at most `max_bytes`. Jobs whose id is in `keep`,
+    e.g. queued and running ones, are left alone. Returns the number of jobs whose files were deleted.
+    """
+    jobs = {}
+    for name in os.listdir(logdir):
+        jobid, dot, suffix = name.partition(".")
+        if not dot or "." + suffix not in LOG_SUFFIXES or jobid in keep:
+            continue
+        path = os.path.join(logdir, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entry = jobs.setdefault(jobid, [0, 0, []])
+        entry[0] = max(entry[0], st.st_mtime)
+        if not os.path.isdir(path):
+            entry[1] += st.st_size
+        entry[2].append(path)
+
+    now = time()
+    total = sum(entry[1] for entry in jobs.values())
+    pruned = 0
+    for mtime, size, paths in sorted(jobs.values()):
+        if not (max_age and now - mtime > max_age) and not (max_bytes and total > max_bytes):
+            break
+        for path in paths:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+        total -= size
+        pruned += 1
+    return pruned
@@ -0,0 +1,363 @@
+import json
+import sqlite3
+from collections import deque, OrderedDict, Counter
+from threading import Condition, Lock, Thread, Event
+from time import time
+from uuid import uuid4
+
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+SUPERSEDED = "superseded"
+CANCELLED = "cancelled"
+TIMED_OUT = "timeout"
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Lane(object):
+    """
+    A named class of jobs. Ready jobs in higher `priority` lanes start first; `limit` caps how many jobs of the lane
+    run at once (0 for no limit).
+    """
+    def __init__(self, name, priority=0, limit=0):
+        self.name = name
+        self.priority = priority
+        self.limit = limit
+
+    @classmethod
+    def parse(cls, spec):
+        """
+        Parse a "name[:priority[:limit]]" string
+        """
+        parts = spec.split(":")
+        if not parts[0] or len(parts) > 3:
+            raise ValueError("lane should be name[:priority[:limit]], got '{}'".format(spec))
+        return cls(parts[0], *[int(p) for p in parts[1:]])
+
+
+DEFAULT_LANE = "default"
+
+
+class QueuedJob(object):
+    """
+    A queued run of a task. Jobs with the same `key` (task name and branch) replace each other while queued if
+    `coalesce` is set, `not_before` delays the job and `concurrency` caps how many runs of the task may run at once.
+    The job runs in `lane` at `priority` (default: the lane's priority) and counts against the concurrency limit of
+    each of `hosts`. A running job is killed after `timeout` seconds. `resume_from` is the id of a failed job whose
+    progress this one picks up. Only workers with all the labels in `requires` may run the job.
+    """
+    def __init__(self, name, args, id=None, state=QUEUED, queued=None, started=None, finished=None, returncode=None,
+                 key=None, coalesce=False, not_before=None, concurrency=None, lane=DEFAULT_LANE, priority=None,
+                 hosts=(), timeout=None, resume_from=None, requires=()):
+        self.id = id or uuid4().hex
+        self.name = name
+        self.args = args
+        self.state = state
+        self.queued = queued or time()
+        self.started = started
+        self.finished = finished
+        self.returncode = returncode
+        self.key = key or name
+        self.coalesce = coalesce
+        self.not_before = not_before
+        self.concurrency = concurrency
+        self.lane = lane or DEFAULT_LANE
+        self.priority = priority
+        self.hosts = list(hosts or ())
+        self.timeout = timeout
+        self.resume_from = resume_from
+        self.requires = list(requires or ())
+
+    def duration(self):
+        if self.started:
+            return (self.finished or time()) - self.started
+
+    def to_dict(self):
+        return {"id": self.id, "name": self.name, "state": self.state, "lane": self.lane, "priority": self.priority,
+                "queued": self.queued, "started": self.started, "finished": self.finished,
+                "duration": self.duration(), "returncode": self.returncode, "resume_from": self.resume_from}
+
+
+class MemoryJobQueue(object):
+    """
+    In-process job queue. `maxsize` bounds the number of queued (not yet running) jobs; 0 means unbounded. The last
+    `history` finished jobs are kept for status lookups. `lanes` is a list of Lane; `host_limit` caps how many running
+    jobs may target the same remote host (0 for no limit).
+    """
+    def __init__(self, maxsize=0, history=1000, lanes=None, host_limit=0):
+        self.maxsize = maxsize
+        self.history = history
+        self.lanes = {lane.name: lane for lane in lanes or []}
+        self.lanes.setdefault(DEFAULT_LANE, Lane(DEFAULT_LANE))
+        self.host_limit = host_limit
+        self.pending = deque()
+        self.jobs = OrderedDict()
+        self.running = Counter()
+        self.running_lanes = Counter()
+        self.running_hosts = Counter()
+        self.cond = Condition()
+
+    def lane(self, job):
+        return self.lanes.get(job.lane) or self.lanes[DEFAULT_LANE]
+
+    def put(self, job):
+        with self.cond:
+            if job.priority is None:
+                job.priority = self.lane(job).priority
+            if job.coalesce:
+                self.supersede(job)
+            if self.maxsize and len(self.pending) >= self.maxsize:
+                raise QueueFull("{} jobs already queued".format(len(self.pending)))
+            self.pending.append(job)
+            self.jobs[job.id] = job
+            self.record(job)
+            self.cond.notify_all()
+
+    def supersede(self, newjob):
+        for job in [j for j in self.pending if j.key == newjob.key]:
+            self.pending.remove(job)
+            job.state = SUPERSEDED
+            job.finished = time()
+            self.record(job)
+            print("Job {} superseded by {}".format(job.id, newjob.id))
+
+    def get(self, labels=None, timeout=None):
+        """
+        Block until a job is ready to run, mark it running and return it. Of the ready jobs, the one with the highest
+        priority that was queued first is picked. Jobs whose debounce delay hasn't passed or that would exceed a task,
+        lane or host concurrency limit are skipped over, as are jobs requiring labels not in `labels`, if given.
+        Returns None if no job became ready within `timeout` seconds.
+        """
+        deadline = time() + timeout if timeout is not None else None
+        with self.cond:
+            while True:
+                job, wait = self.next_ready(labels)
+                if job:
+                    break
+                if deadline is not None:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        return None
+                    wait = min(wait, remaining) if wait else remaining
+                self.cond.wait(wait)
+            self.pending.remove(job)
+            self.running[job.name] += 1
+            self.running_lanes[self.lane(job).name] += 1
+            for host in job.hosts:
+                self.running_hosts[host] += 1
+            job.state = RUNNING
+            job.started = time()
+            self.record(job)
+            return job
+
+    def next_ready(self, labels=None):
+        """
+        Return the runnable pending job to start next, or None and how long to wait before a delayed job becomes ready
+        """
+        now = time()
+        wait = None
+        best = None
+        for job in self.pending:
+            if best and job.priority <= best.priority:
+                continue
+            if labels is not None and not labels.issuperset(job.requires):
+                continue
+            if job.not_before and job.not_before > now:
+                wait = min(wait, job.not_before - now) if wait else job.not_before - now
+                continue
+            if job.concurrency and self.running[job.name] >= job.concurrency:
+                continue
+            lane = self.lane(job)
+            if lane.limit and self.running_lanes[lane.name] >= lane.limit:
+                continue
+            if self.host_limit and any(self.running_hosts[host] >= self.host_limit for host in job.hosts):
+                continue
+            best = job
+        return best, None if best else wait
+
+    def release(self, job):
+        self.running[job.name] -= 1
+        self.running_lanes[self.lane(job).name] -= 1
+        for host in job.hosts:
+            self.running_hosts[host] -= 1
+
+    def finish(self, job, returncode, state=None):
+        """
+        Mark a running job finished. The final state is derived from `returncode` unless given, e.g. for killed jobs.
+        """
+        with self.cond:
+            self.release(job)
+            job.returncode = returncode
+            job.state = state or (SUCCEEDED if returncode == 0 else FAILED)
+            job.finished = time()
+            self.record(job)
+            self.trim()
+            self.cond.notify_all()
+
+    def requeue(self, job):
+        """
+        Put a running job back at the front of the queue, e.g. when the worker running it has gone away
+        """
+        with self.cond:
+            self.release(job)
+            job.state = QUEUED
+            job.started = None
+            self.pending.appendleft(job)
+            self.record(job)
+            self.cond.notify_all()
+
+    def cancel(self, job):
+        """
+        Drop `job` from the queue if it hasn't started yet. Returns False if it is not queued.
+        """
+        with self.cond:
+            if job.state != QUEUED or job not in self.pending:
+                return False
+            self.pending.remove(job)
+            job.state = CANCELLED
+            job.finished = time()
+            self.record(job)
+            self.trim()
+            self.cond.notify_all()
+            return True
+
+    def trim(self):
+        finished = [j for j in self.jobs.values() if j.finished]
+        for job in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[job.id]
+
+    def depth(self):
+        with self.cond:
+            return len(self.pending)
+
+    def lookup(self, jobid):
+        with self.cond:
+            return self.jobs.get(jobid)
+
+    def unfinished(self):
+        """
+        Return the ids of queued and running jobs
+        """
+        with self.cond:
+            return {job.id for job in self.jobs.values() if not job.finished}
+
+    def recent(self, limit=100):
+        """
+        Return up to `limit` of the most recently queued jobs, newest first
+        """
+        with self.cond:
+            return list(reversed(self.jobs.values()))[:limit]
+
+    def record(self, job):
+        """
+        Called with the queue lock held whenever a job changes state
+        """
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteJobQueue(MemoryJobQueue):
+    """
+    Job queue persisted to a SQLite database in WAL mode. State changes are buffered and committed in batches by a
+    writer thread every `commit_interval` seconds, so enqueueing never waits on disk. Jobs that were queued or running
+    when the server stopped are queued again on startup.
+    """
+    columns = ["id", "name", "args", "state", "queued", "started", "finished", "returncode",
+               "key", "coalesce", "not_before", "concurrency", "lane", "priority", "hosts", "timeout", "resume_from",
+               "requires"]
+    added_columns = {"key": "TEXT", "coalesce": "INTEGER", "not_before": "REAL", "concurrency": "INTEGER",
+                     "lane": "TEXT", "priority": "INTEGER", "hosts": "TEXT", "timeout": "REAL",
+                     "resume_from": "TEXT", "requires": "TEXT"}
+
+    def __init__(self, path, maxsize=0, history=1000, lanes=None, host_limit=0, commit_interval=0.05):
+        super().__init__(maxsize, history, lanes, host_limit)
+        self.path = path
+        self.commit_interval = commit_interval
+        self.dirty = OrderedDict()
+        self.dirty_lock = Lock()
+        self.db_lock = Lock()
+        self.stopped = Event()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, name TEXT, args TEXT, state TEXT, "
+                        "queued REAL, started REAL, finished REAL, returncode INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)")
+        self.migrate()
+        self.db.commit()
+        self.recover()
+        self.writer = Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def migrate(self):
+        existing = {row[1] for row in self.db.execute("PRAGMA table_info(jobs)")}
+        for column, coltype in self.added_columns.items():
+            if column not in existing:
+                self.db.execute("ALTER TABLE jobs ADD COLUMN \"{}\" {}".format(column, coltype))
+
+    def column_list(self):
+        return ", ".join('"{}"'.format(c) for c in self.columns)
+
+    def recover(self):
+        rows = self.db.execute("SELECT {} FROM jobs WHERE state IN (?, ?) ORDER BY queued".format(self.column_list()),
+                               (QUEUED, RUNNING)).fetchall()
+        for row in rows:
+            job = self.row_job(row)
+            job.state = QUEUED
+            job.started = job.finished = job.returncode = None
+            self.pending.append(job)
+            self.jobs[job.id] = job
+            self.record(job)
+        if rows:
+            print("Recovered {} queued jobs".format(len(rows)))
+
+    def row_job(self, row):
+        fields = dict(zip(self.columns, row))
+        fields.update(args=json.loads(fields["args"]), coalesce=bool(fields["coalesce"]),
+                      hosts=json.loads(fields["hosts"] or "[]"), requires=json.loads(fields["requires"] or "[]"))
+        return QueuedJob(**fields)
+
+    def record(self, job):
+        with self.dirty_lock:
+            self.dirty[job.id] = (job.id, job.name, json.dumps(job.args), job.state, job.queued, job.started,
+                                  job.finished, job.returncode, job.key, job.coalesce, job.not_before,
+                                  job.concurrency, job.lane, job.priority, json.dumps(job.hosts), job.timeout,
+                                  job.resume_from, json.dumps(job.requires))
+
+    def flush(self):
+        with self.dirty_lock:
+            rows, self.dirty = list(self.dirty.values()), OrderedDict()
+        if rows:
+            with self.db_lock:
+                self.db.executemany("INSERT OR REPLACE INTO jobs ({}) VALUES ({})".format(
+                    self.column_list(), ", ".join("?" * len(self.columns))), rows)
+                self.db.commit()
+
+    def lookup(self, jobid):
+        """
+        Jobs that have dropped out of the in-memory history are read from the database
+        """
+        job = super().lookup(jobid)
+        if job is None:
+            with self.db_lock:
+                row = self.db.execute("SELECT {} FROM jobs WHERE id=?".format(self.column_list()), (jobid, )).fetchone()
+            if row:
+                job = self.row_job(row)
+        return job
+
+    def write_loop(self):
+        while not self.stopped.wait(self.commit_interval):
+            self.flush()
+
+    def close(self):
+        self.stopped.set()
+        self.writer.join()
+        self.flush()
+        self.db.close()
@@ -0,0 +1,567 @@
+import os
+import json
+import codecs
+import random
+import asyncio
+import subprocess
+import importlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from time import time, perf_counter
+from shipper.cache import hash_files, ArtifactCache
+from shipper.joblog import JobLog
+
+
+class ShipperJob(object):
+    """
+    Job representation class. Tasks write their output to `log`, which the runner replaces with one that also records
+    structured events. An `ssh_pool` passed in is left open when the job ends, for its owner to reuse and close.
+    """
+    def __init__(self, ssh_pool=None):
+        from shipper.lib.ssh import SshPool
+        self.tasks = []
+        self.props = {}
+        self.ssh = ssh_pool or SshPool()
+        self.owns_ssh = ssh_pool is None
+        self.timings = []
+        self.artifacts = None
+        self.log = JobLog()
+
+    def default_connection(self, connection):
+        self.props["connection"] = connection
+
+    def cache_key(self, prefix, *paths):
+        """
+        Build an artifact cache key from `prefix` and the contents of `paths`, e.g.
+        job.cache_key("node_modules", "code/package-lock.json")
+        """
+        return "{}-{}".format(prefix, hash_files(*paths))
+
+    def restore_cache(self, key, path):
+        """
+        Restore the directory cached under `key` to `path`. Returns True if there was a cache hit.
+        """
+        self.artifacts = self.artifacts or ArtifactCache()
+        hit = self.artifacts.restore(key, path)
+        self.log.info("Cache {} for {}".format("hit" if hit else "miss", key))
+        return hit
+
+    def save_cache(self, key, path):
+        self.artifacts = self.artifacts or ArtifactCache()
+        self.artifacts.save(key, path)
+
+    def add_task(self, task, timeout=None, retry=None, overlap=False, after=None):
+        """
+        Append `task` to the job. With `timeout`, the task fails if it runs for longer than that many seconds. `retry`
+        is a Retry policy, or a number of attempts, for tasks that may fail transiently. With `overlap`, the job goes on
+        with the following tasks while this one runs, e.g. to build an image while static files are uploaded; the job
+        waits for it before finishing, and fails as soon as it fails. `after` is a list of tasks already added to the
+        job that must finish before this one starts, e.g. pushing the image once the overlapping build is done.
+        """
+        if timeout is not None:
+            task.timeout = timeout
+        if retry is not None:
+            task.retry = retry if isinstance(retry, Retry) else Retry(retry)
+        if overlap:
+            task.overlap = True
+        if after:
+            for other in after:
+                if other not in self.tasks:
+                    raise ValueError("{} must be added to the job before tasks that run after it".format(other))
+            task.after = list(after)
+        task.validate(self)
+        self.tasks.append(task)
+
+    def run(self, args, checkpoint=None):
+        """
+        Run the job's tasks in order, on an event loop: see run_async()
+        """
+        asyncio.run(self.run_async(args, checkpoint))
+
+    async def run_async(self, args, checkpoint=None):
+        """
+        Run the job's tasks in order, starting overlapping tasks and moving on. With a `checkpoint`, progress is saved
+        after every step and a previous, failed run's progress is picked up: its props are restored and the steps it
+        completed are skipped. LambdaTasks are always run again so the steps they generate line up with the previous
+        run. While overlapping tasks are running no progress is saved, as they may not complete.
+        """
+        self.props.update(**args)
+        done = checkpoint.restore(self) if checkpoint else 0
+        step = 0
+        overlapping = set()
+        started = {}  # overlapping tasks -> their futures, for tasks that run after them
+        try:
+            while self.tasks:
+                task = self.tasks.pop(0)
+                step += 1
+                if step <= done and not isinstance(task, LambdaTask):
+                    self.log.info("Skipping {}, completed by the previous run".format(task))
+                    continue
+                self.log.info("******************************************************************************\n" +
+                              "* {: <74} *\n".format(str(task) + (" (overlapping)" if task.overlap else "")) +
+                              "******************************************************************************")
+                future = asyncio.ensure_future(self.run_after(task, started))
+                if task.overlap:
+                    started[task] = future
+                    overlapping.add(future)
+                else:
+                    await self.wait_step(future, overlapping)
+                    if checkpoint and not overlapping:
+                        checkpoint.save(self, step)
+                self.log.info("")
+            await self.wait_step(None, overlapping)
+        finally:
+            for future in overlapping:
+                future.cancel()
+            await asyncio.gather(*overlapping, return_exceptions=True)
+            if self.owns_ssh:
+                self.ssh.close()
+
+    @staticmethod
+    async def wait_step(step, overlapping):
+        """
+        Wait for the future of a step, or with no `step` for all `overlapping` ones. Overlapping steps that finish are
+        removed from the set; if one fails, `step` is cancelled and the failure raised.
+        """
+        while overlapping or step:
+            waiting = overlapping | {step} if step else overlapping
+            done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            for future in done - {step}:
+                overlapping.discard(future)
+                if future.exception():
+                    if step:
+                        step.cancel()
+                        await asyncio.gather(step, return_exceptions=True)
+                    raise future.exception()
+            if step in done:
+                return step.result()
+
+    async def run_after(self, task, started):
+        """
+        Run `task` once the overlapping tasks it was added `after` have finished. Fails if one of them failed.
+        """
+        for other in task.after:
+            future = started.get(other)  # others completed before it started, or by a previous run
+            if future is None:
+                continue
+            if not future.done():
+                self.log.info("Waiting for {}".format(other))
+            await asyncio.shield(future)  # cancelling this task mustn't cancel the other
+        await self.run_task_async(task)
+
+    async def run_task_async(self, task):
+        """
+        Run a task, retrying it according to its retry policy, recording when each attempt started, how long it took
+        and whether it succeeded in `self.timings`. Tasks that block are run in a thread. A task that times out is
+        cancelled, which kills the processes it started; the thread of a blocking task is abandoned, its processes are
+        killed when the job exits.
+        """
+        delays = task.retry.delays() if task.retry else iter(())
+        attempt = 1
+        while True:
+            timing = {"task": str(task), "class": type(task).__name__, "start": time(), "ok": False,
+                      "attempt": attempt}
+            self.log.task_start(task, attempt)
+            started = perf_counter()
+            try:
+                run = run_blocking(task.run, self) if is_blocking(task) else task.run_async(self)
+                if task.timeout:
+                    try:
+                        await asyncio.wait_for(run, task.timeout)
+                    except asyncio.TimeoutError:
+                        raise TaskTimeout("{} timed out after {}s".format(task, task.timeout)) from None
+                else:
+                    await run
+                timing["ok"] = True
+                return
+            except StopJob:
+                raise
+            except Exception as e:
+                delay = next(delays, None)
+                if delay is None or not task.retry.retries(e):
+                    raise
+                self.log.info("{} failed ({}: {}), retrying in {:.1f}s".format(task, type(e).__name__, e, delay))
+            finally:
+                timing["duration"] = perf_counter() - started
+                self.timings.append(timing)
+                self.log.task_end(task, timing)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def run_task(self, task):
+        """
+        run_task_async() for blocking code, such as run() of a task grouping others
+        """
+        run_sync(self.run_task_async(task))
+
+
+class Retry(object):
+    """
+    Retry policy for a task: up to `attempts` runs in total, waiting an exponentially increasing delay - `delay` times
+    `backoff` to the power of the retry number, capped at `max_delay` - between them. With `jitter` the actual wait is
+    picked at random below that, so jobs that failed together don't retry in lockstep. Only exceptions of the types
+    in `on` are retried.
+    """
+    def __init__(self, attempts=3, delay=1, backoff=2, max_delay=60, jitter=True, on=(Exception, )):
+        self.attempts = attempts
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.on = on
+
+    def retries(self, exc):
+        return isinstance(exc, self.on)
+
+    def delays(self):
+        for n in range(self.attempts - 1):
+            delay = min(self.max_delay, self.delay * self.backoff ** n)
+            yield random.uniform(0, delay) if self.jitter else delay
+
+
+class Checkpoint(object):
+    """
+    A job's progress, saved to a JSON file at `path` after each step: how many steps have completed and the props that
+    can be serialized. Props that can't, like connections, are expected to be set up again by the job file.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def restore(self, job):
+        """
+        Load saved props into `job` and return the number of steps completed, 0 if there is no checkpoint
+        """
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return 0
+        job.props.update(state["props"])
+        job.log.info("Resuming after step {}".format(state["steps"]))
+        return state["steps"]
+
+    def save(self, job, steps):
+        props = {}
+        for key, value in job.props.items():
+            try:
+                json.dumps(value)
+            except (TypeError, ValueError):
+                continue
+            props[key] = value
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"steps": steps, "props": props}, f)
+        os.replace(tmp, self.path)
+
+
+class StopJob(Exception):
+    pass
+
+
+class TaskTimeout(Exception):
+    pass
+
+
+async def run_blocking(func, *args):
+    """
+    Call blocking `func` in a thread of its own without holding up the event loop, in the caller's context so its
+    output is attributed to the task running it. The thread is a daemon: if the caller is cancelled, e.g. because the
+    task timed out, it can't be interrupted, but it is abandoned rather than keeping the job from exiting.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    context = contextvars.copy_context()
+
+    def settle(setter, value):
+        if not future.done():  # cancelled
+            setter(value)
+
+    def call():
+        try:
+            result = (future.set_result, context.run(func, *args))
+        except BaseException as e:
+            result = (future.set_exception, e)
+        try:
+            loop.call_soon_threadsafe(settle, *result)
+        except RuntimeError:  # the loop is gone, the job has ended
+            pass
+
+    Thread(target=call, daemon=True).start()
+    return await future
+
+
+async def run_process(job, cmd, env=None, capture=False, check=True):
+    """
+    Run `cmd`, a list or a shell command line, writing its output to the job's log as it arrives or, with `capture`,
+    collecting it. Returns the exit status and the captured output. With `check`, a non-zero exit status raises
+    CalledProcessError. If the caller is cancelled, e.g. because the task timed out, the process is killed.
+    """
+    # output is read from a pipe of our own rather than one asyncio manages, as waiting for a process with the latter
+    # also waits for the pipe to close, which a killed process's children may keep open
+    readfd, writefd = os.pipe()
+    try:
+        if isinstance(cmd, list):
+            proc = await asyncio.create_subprocess_exec(*cmd, stdout=writefd, stderr=writefd, env=env)
+        else:
+            proc = await asyncio.create_subprocess_shell(cmd, stdout=writefd, stderr=writefd, env=env)
+    except BaseException:
+        os.close(readfd)
+        raise
+    finally:
+        os.close(writefd)
+    reader = asyncio.StreamReader()
+    transport, _ = await asyncio.get_running_loop().connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),
+                                                                      open(readfd, "rb", buffering=0))
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    output = []
+    try:
+        while True:
+            chunk = await reader.read(32768)
+            if not chunk:
+                break
+            if capture:
+                output.append(chunk)
+            else:
+                job.log.write(decoder.decode(chunk))
+        job.log.write(decoder.decode(b"", final=True))
+        returncode = await proc.wait()
+    except BaseException:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+    finally:
+        transport.close()
+    output = b"".join(output)
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, output if capture else None)
+    return returncode, output
+
+
+def run_sync(coro):
+    """
+    Run coroutine `coro` to completion from blocking code. The caller may itself be running on an event loop, so the
+    coroutine gets a loop in a thread of its own, in the caller's context.
+    """
+    context = contextvars.copy_context()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(context.run, asyncio.run, coro).result()
+
+
+def is_blocking(task):
+    """
+    Whether `task` is run with run() in a thread rather than with run_async() on the event loop: whichever of the two
+    its class defines last, so a subclass overriding run() of a task written as a coroutine still has its run() called
+    """
+    for cls in type(task).__mro__:
+        if "run_async" in cls.__dict__:
+            return False
+        if "run" in cls.__dict__:
+            return True
+    return False
+
+
+class ShipperConnection(object):
+    pass
+
+
+class ShipperTask(object):
+    """
+    Tasks implement either run(), which may block and is called in a thread, or the coroutine run_async(), which is
+    run on the job's event loop so must not block, e.g. awaiting processes started with run_process(). Either can be
+    called on any task.
+    """
+    # see ShipperJob.add_task
+    timeout = None
+    retry = None
+    overlap = False
+    after = ()
+
+    def __init__(self):
+        pass
+
+    def validate(self, job):
+        pass
+
+    def run(self, job):
+        if type(self).run_async is ShipperTask.run_async:
+            raise NotImplementedError()
+        run_sync(self.run_async(job))
+
+    async def run_async(self, job):
+        await run_blocking(self.run, job)
+
+
+class CmdTask(ShipperTask):
+    """
+    Execute a command locally
+    """
+    def __init__(self, command):
+        super().__init__()
+        self.command = command
+
+    def validate(self, job):
+        assert self.command
+
+    async def run_async(self, job):
+        await run_process(job, self.command)
+
+    def __repr__(self):
+        return "<CmdTask cmd='{}'>".format(str(self.command)[0:50])
+
+
+class PythonTask(ShipperTask):
+    """
+    Call an arbitrary function passing a reference to the ShipperJob being executed. The function may be a coroutine
+    function, which is run on the job's event loop; others are run in a thread.
+    """
+    def __init__(self, func):
+        super().__init__()
+        self.func = func
+
+    def run(self, job):
+        if asyncio.iscoroutinefunction(self.func):
+            return super().run(job)
+        self.func(job)
+
+    async def run_async(self, job):
+        if asyncio.iscoroutinefunction(self.func):
+            await self.func(job)
+        else:
+            await run_blocking(self.func, job)
+
+    def __repr__(self):
+        return "<PythonTask func='{}'>".format(self.func)
+
+
+class LambdaTask(ShipperTask):
+    """
+    Run tasks generated by this task at execution time. Func should return a list of tasks.
+    """
+    def __init__(self, func):
+        super().__init__()
+        self.func = func
+
+    def run(self, job):
+        self.expand(job, job.tasks)
+
+    def expand(self, job, tasks):
+        inserted = 0
+        steps = self.func(job)
+        if steps:
+            for newstep in steps:
+                newstep.validate(job)
+                tasks.insert(inserted, newstep)
+                inserted += 1
+        job.log.info("Prepended {} steps".format(inserted))
+
+    def __repr__(self):
+        return "<LambdaTask func='{}'>".format(self.func)
+
+
+class SerialTask(ShipperTask):
+    """
+    Run a list of tasks in order. Mostly useful inside a ParallelTask, e.g. to rsync and then restart a service on each
+    of several hosts. Tasks generated by a LambdaTask in the list are inserted into this list.
+    """
+    def __init__(self, tasks):
+        super().__init__()
+        self.tasks = list(tasks)
+
+    def validate(self, job):
+        for task in self.tasks:
+            task.validate(job)
+
+    async def run_async(self, job):
+        tasks = list(self.tasks)
+        while tasks:
+            task = tasks.pop(0)
+            job.log.info("* {}".format(task))
+            if isinstance(task, LambdaTask):
+                await run_blocking(task.expand, job, tasks)
+            else:
+                await job.run_task_async(task)
+
+    def __repr__(self):
+        return "<SerialTask tasks={}>".format(len(self.tasks))
+
+
+class ParallelTask(ShipperTask):
+    """
+    Run a group of tasks concurrently, at most `max_workers` at a time. The job continues once every task in the group
+    has finished; if any failed, the first failure (in list order) is raised, so StopJob behaves as it would if the
+    tasks had run serially. Tasks generated by a LambdaTask in the group run after the group.
+    """
+    def __init__(self, tasks, max_workers=None):
+        super().__init__()
+        self.tasks = list(tasks)
+        self.max_workers = max_workers
+
+    def validate(self, job):
+        for task in self.tasks:
+            task.validate(job)
+
+    async def run_async(self, job):
+        if not self.tasks:
+            return
+        slots = asyncio.Semaphore(self.max_workers or len(self.tasks))
+
+        async def run_task(task):
+            async with slots:
+                job.log.info("* {}".format(task))
+                await job.run_task_async(task)
+
+        results = await asyncio.gather(*[run_task(task) for task in self.tasks], return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    def __repr__(self):
+        return "<ParallelTask tasks={}>".format(len(self.tasks))
+
+
+# Tasks needing heavy dependencies live in their own modules, which are imported when a job file first asks for one of
+# their names, e.g. `from shipper.lib import GitCheckoutTask` imports shipper.lib.checkout and GitPython. Jobs using
+# only the tasks above don't pay for loading libraries they never use.
+LAZY_NAMES = {
+    "SshConnection": "ssh",
+    "SshPool": "ssh",
+    "SshTask": "ssh",
+    "ScriptTask": "ssh",
+    "RsyncTask": "rsync",
+    "GitCheckoutTask": "checkout",
+    "GiteaCheckoutTask": "checkout",
+    "DockerCli": "docker",
+    "docker_cli": "docker",
+    "image_repository": "docker",
+    "DockerBuildTask": "docker",
+    "DockerPushTask": "docker",
+    "DockerTagTask": "docker",
+}
+
+__all__ = ["ShipperJob", "Retry", "Checkpoint", "StopJob", "TaskTimeout", "run_blocking", "run_process",
+           "ShipperConnection", "ShipperTask", "CmdTask", "PythonTask", "LambdaTask", "SerialTask",
+           "ParallelTask"] + list(LAZY_NAMES)
+
+
+def __getattr__(name):
+    module = LAZY_NAMES.get(name)
+    if module is None:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module("shipper.lib." + module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(LAZY_NAMES))
+
+
+def preload():
+    """
+    Import every task module and the libraries they use up front, e.g. before forking jobs so they don't each pay for it
+    """
+    for module in sorted(set(LAZY_NAMES.values())):
+        importlib.import_module("shipper.lib." + module)
+    import paramiko  # NOQA - only imported by SshConnection.connect otherwise
@@ -0,0 +1,172 @@
+import os
+import json
+import hashlib
+from time import time
+from git import Repo
+from shipper.cache import cache_dir, locked
+from shipper.lib import StopJob
+from shipper.lib.ssh import SshTask
+
+
+class GitCheckoutTask(SshTask):
+    """
+    Check out a git repo to the local disk.
+
+    With `cache` set, a bare mirror of the remote is kept in the shared cache dir and updated with an incremental fetch;
+    the checkout is then cloned from the mirror using alternates, so only new objects cross the network. `depth`,
+    `single_branch` and `filter` (e.g. "blob:none" for a partial clone) limit what is fetched.
+    """
+    def __init__(self, repo, dest, branch="master", connection=None, gitopts=None, cache=False, depth=None,
+                 single_branch=False, filter=None):
+        super().__init__(None, connection)
+        self.repo = repo
+        self.dest = dest
+        self.gitopts = gitopts
+        self.branch = branch
+        self.cache = cache
+        self.depth = depth
+        self.single_branch = single_branch
+        self.filter = filter
+
+    def validate(self, job):
+        assert (self.repo.startswith("ssh") and (self.connection or job.props.get("connection"))) \
+            or self.repo.startswith("http")
+        super().validate(job)
+
+    def run(self, job):
+        os.makedirs(self.dest, exist_ok=True)
+        fetch_env = {"GIT_TERMINAL_PROMPT": "0"}
+        if self.repo.startswith("ssh"):
+            fetch_env["GIT_SSH_COMMAND"] = self.conn.ssh_command(job.ssh.control_path())
+
+        if os.path.isdir(os.path.join(self.dest, ".git")):
+            repo = self.update_checkout(job, fetch_env)
+        elif self.cache:
+            repo = self.checkout_from_mirror(job, fetch_env)
+        else:
+            repo = Repo.init(self.dest)
+            origin = repo.create_remote('origin', self.repo)
+            with repo.git.custom_environment(**fetch_env):
+                origin.fetch(self.refspec(), **self.fetch_opts())
+                origin.pull(origin.refs[0].remote_head, **self.fetch_opts())
+            repo.git.checkout(self.branch)
+
+        job.props["git_commit"] = repo.head.commit.hexsha
+        job.log.info(repo.git.execute(["git", "log", "-1"]) + "\n")
+        job.log.info(repo.git.execute(["git", "log", "--pretty=oneline", "-10"]))
+
+    def short_branch(self):
+        if self.branch.startswith("refs/heads/"):
+            return self.branch[len("refs/heads/"):]
+        return self.branch
+
+    def refspec(self):
+        if self.single_branch:
+            return "+refs/heads/{0}:refs/remotes/origin/{0}".format(self.short_branch())
+
+    def fetch_opts(self):
+        opts = {}
+        if self.depth:
+            opts["depth"] = self.depth
+        if self.filter:
+            opts["filter"] = self.filter
+        return opts
+
+    def update_checkout(self, job, fetch_env):
+        """
+        Bring an existing checkout (e.g. in a persistent workspace) up to date with the remote branch
+        """
+        repo = Repo(self.dest)
+        branch = self.short_branch()
+        source = self.update_mirror(job, fetch_env) if self.cache else self.repo
+        if "origin" in [r.name for r in repo.remotes]:
+            repo.git.remote("set-url", "origin", self.repo)
+        else:
+            repo.create_remote("origin", self.repo)
+        with repo.git.custom_environment(**fetch_env):
+            repo.git.fetch(source, "+refs/heads/{0}:refs/remotes/origin/{0}".format(branch), **self.fetch_opts())
+        repo.git.checkout("-f", "-B", branch, "origin/" + branch)
+        return repo
+
+    def checkout_from_mirror(self, job, fetch_env):
+        mirror = self.update_mirror(job, fetch_env)
+        repo = Repo.clone_from(mirror, self.dest, shared=True, no_checkout=True)
+        repo.git.remote("set-url", "origin", self.repo)
+        repo.git.checkout(self.short_branch())
+        return repo
+
+    def update_mirror(self, job, fetch_env):
+        """
+        Create or incrementally update the bare mirror of self.repo. Concurrent jobs for the same remote serialize on a
+        lock file; a job that waited while another one fetched skips its own fetch, if that fetch started after this job
+        began waiting, so it saw whatever was pushed before, and fetched at least what this job would.
+        """
+        path = os.path.join(cache_dir("git"), hashlib.sha1(self.repo.encode("utf-8")).hexdigest())
+        stamp = path + ".fetched"
+        refspec = "+refs/heads/{0}:refs/heads/{0}".format(self.short_branch()) if self.single_branch else None
+        waiting_since = time()
+        with locked(path + ".lock"):
+            if self.fetched_since(stamp, waiting_since, refspec):
+                job.log.info("Mirror of {} was just updated by another job".format(self.repo))
+                return path
+            if not os.path.exists(path):
+                mirror = Repo.init(path, bare=True)
+                mirror.git.remote("add", "--mirror=fetch", "origin", self.repo)
+            else:
+                mirror = Repo(path)
+            started = time()
+            with mirror.git.custom_environment(**fetch_env):
+                mirror.remote("origin").fetch(refspec, prune=not self.single_branch, **self.fetch_opts())
+            with open(stamp, "w") as f:
+                json.dump({"started": started, "refspec": refspec, "opts": self.fetch_opts()}, f)
+        return path
+
+    def fetched_since(self, stamp, since, refspec):
+        """
+        Whether the last fetch recorded in `stamp` started after `since` and covered `refspec` with the same options. A
+        fetch of all branches covers any single one.
+        """
+        try:
+            with open(stamp) as f:
+                last = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return last.get("started", 0) >= since and last.get("refspec") in (None, refspec) \
+            and last.get("opts") == self.fetch_opts()
+
+    def __repr__(self):
+        return "<GitCheckoutTask repo='{}'>".format(self.repo)
+
+
+class GiteaCheckoutTask(GitCheckoutTask):
+    """
+    Check out whatever git repo and branch the incoming data from Gitea referenced
+    """
+    def __init__(self, dest, connection=None, gitopts=None, allow_branches=None, **kwargs):
+        super().__init__(None, dest, None, connection, gitopts, **kwargs)
+        self.allow_branches = allow_branches
+
+    def validate(self, job):
+        self.conn = self.connection or job.props.get("connection")
+        assert self.conn
+
+    def run(self, job):
+        data = job.props["payload"]
+        if self.conn.key:
+            self.repo = data["repository"]["ssh_url"]
+        else:
+            self.repo = data["repository"]["clone_url"]. \
+                replace("://", "://{}:{}@".format(self.conn.username, self.conn.password))
+        self.branch = data["ref"]
+        if self.allow_branches:
+            branch = self.branch
+            if branch.startswith("refs/heads/"):
+                branch = branch[len("refs/heads/"):]
+            if branch not in self.allow_branches:
+                raise StopJob("Branch '{}' is not whitelisted".format(branch))
+
+        job.log.info(self.repo)
+        super().run(job)
+
+    def __repr__(self):
+        return "<GiteaCheckoutTask>"
@@ -0,0 +1,134 @@
+import os
+import asyncio
+from shipper.lib import ShipperTask, run_process
+
+
+class DockerCli(object):
+    """
+    Runs docker commands on the job's event loop. Set job.props["docker_cli"] to an instance to use a different binary
+    (e.g. a stand-in script for testing); the default binary can also be changed with $SHIPPER_DOCKER.
+    """
+    def __init__(self, binary=None, buildkit=True):
+        self.binary = binary or os.environ.get("SHIPPER_DOCKER", "docker")
+        self.buildkit = buildkit
+
+    def env(self):
+        env = dict(os.environ)
+        if self.buildkit:
+            env["DOCKER_BUILDKIT"] = "1"
+        return env
+
+    async def run_async(self, job, *args):
+        cmd = [self.binary] + list(args)
+        job.log.info("Calling {}".format(cmd))
+        await run_process(job, cmd, env=self.env())
+
+    async def image_exists_async(self, job, image):
+        returncode, _ = await run_process(job, [self.binary, "image", "inspect", image], env=self.env(), capture=True,
+                                          check=False)
+        return returncode == 0
+
+
+def docker_cli(job):
+    return job.props.get("docker_cli") or DockerCli()
+
+
+def image_repository(image):
+    """
+    Strip the tag from an image name: "reg:5000/foo/bar:1.0" -> "reg:5000/foo/bar"
+    """
+    name, sep, tag = image.rpartition(":")
+    if sep and "/" not in tag:
+        return name
+    return image
+
+
+class DockerBuildTask(ShipperTask):
+    """
+    Build a docker image. The image is also tagged with the commit checked out by a preceding GitCheckoutTask, and if
+    an image for that commit already exists locally the build is skipped and the existing image is tagged instead.
+
+    Layers are reused from `cache_from` (default: job.props["docker_tag"], i.e. the previously pushed image), and
+    images are built with inline cache metadata so the next build can do the same. Build args come from `build_args`
+    or job.props["docker_build_args"].
+    """
+    def __init__(self, imagename=None, codedir=None, cache_from=None, build_args=None, skip_existing=True):
+        super().__init__()
+        self.imagename = imagename
+        self.codedir = codedir
+        self.cache_from = cache_from
+        self.build_args = build_args
+        self.skip_existing = skip_existing
+
+    async def run_async(self, job):
+        docker = docker_cli(job)
+        imagename = self.imagename or job.props.get("docker_imagename")
+        codedir = self.codedir or job.props.get("docker_codedir") or "code"
+
+        commit_image = None
+        if job.props.get("git_commit"):
+            commit_image = "{}:{}".format(image_repository(imagename), job.props["git_commit"][0:12])
+            if self.skip_existing and await docker.image_exists_async(job, commit_image):
+                job.log.info("{} already exists, skipping build".format(commit_image))
+                await docker.run_async(job, "tag", commit_image, imagename)
+                return
+
+        cmd = ["build", "-t", imagename]
+        if commit_image:
+            cmd += ["-t", commit_image]
+        cache_from = self.cache_from or job.props.get("docker_tag")
+        if cache_from:
+            cmd += ["--cache-from", cache_from]
+        if docker.buildkit:
+            cmd += ["--build-arg", "BUILDKIT_INLINE_CACHE=1"]
+        build_args = self.build_args if self.build_args is not None else job.props.get("docker_build_args", {})
+        for key, value in sorted(build_args.items()):
+            cmd += ["--build-arg", "{}={}".format(key, value)]
+        await docker.run_async(job, *(cmd + [codedir]))
+
+    def __repr__(self):
+        return "<DockerBuildTask>"
+
+
+class DockerPushTask(ShipperTask):
+    """
+    Push an image, plus any extra `tags`, to their registries. Multiple pushes run concurrently.
+    """
+    def __init__(self, imagename=None, tags=None, max_workers=4):
+        super().__init__()
+        self.imagename = imagename
+        self.tags = tags
+        self.max_workers = max_workers
+
+    async def run_async(self, job):
+        docker = docker_cli(job)
+        images = [self.imagename or job.props.get("docker_imagename")] + list(self.tags or [])
+        slots = asyncio.Semaphore(max(1, self.max_workers))
+
+        async def push(image):
+            async with slots:
+                await docker.run_async(job, "push", image)
+
+        results = await asyncio.gather(*[push(image) for image in images], return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    def __repr__(self):
+        return "<DockerPushTask>"
+
+
+class DockerTagTask(ShipperTask):
+    def __init__(self, imagename=None, tag=None):
+        super().__init__()
+        self.imagename = imagename
+        self.tag = tag
+
+    async def run_async(self, job):
+        imagename = self.imagename or job.props.get("docker_imagename")
+        tag = self.tag or job.props.get("docker_tag")
+        await docker_cli(job).run_async(job, "tag", imagename, tag)
+        job.props["docker_imagename"] = tag
+
+    def __repr__(self):
+        return "<DockerTagTask>"
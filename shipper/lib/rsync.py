@@ -0,0 +1,162 @@
+import os
+import json
+import asyncio
+import hashlib
+import subprocess
+from time import perf_counter
+from shipper.cache import cache_dir
+from shipper.lib import run_blocking, run_process
+from shipper.lib.ssh import SshTask
+
+
+class RsyncTask(SshTask):
+    """
+    Rsync a file tree from the local disk to one or more remote systems. With a list of destinations, up to
+    `max_workers` transfers run at once. `compress=False` drops -z, which is usually faster on a LAN.
+
+    With `skip_unchanged`, a manifest (path, size, mtime and content hash of every file) of the source is computed and
+    a destination is skipped if the last successful sync to it was of an identical tree and options. Only use this if
+    nothing else modifies the destination.
+
+    Per-destination stats (bytes sent, duration, skipped) are kept in `self.result` and job.props["rsync_stats"].
+    """
+    def __init__(self, src, dest, connection=None, exclude=None, delete=False, flags=None, compress=True,
+                 max_workers=4, skip_unchanged=False):
+        super().__init__(None, connection)
+        self.src = src
+        self.dest = dest
+        self.exclude = exclude
+        self.delete = delete
+        self.flags = flags
+        self.compress = compress
+        self.max_workers = max_workers
+        self.skip_unchanged = skip_unchanged
+        self.result = {}
+
+    def destinations(self):
+        return [self.dest] if isinstance(self.dest, str) else list(self.dest)
+
+    def rsync_command(self, job, dest):
+        rsync_cmd = ["rsync", "-avzr" if self.compress else "-avr", "--stats"]
+
+        if self.conn:
+            rsync_cmd += ["-e", self.conn.ssh_command(job.ssh.control_path())]
+
+        if self.exclude:
+            for item in self.exclude:
+                rsync_cmd += ["--exclude={}".format(item)]
+
+        if self.delete:
+            rsync_cmd += ["--delete"]
+
+        if self.flags:
+            rsync_cmd += self.flags
+
+        rsync_cmd += [self.src, dest]
+        return rsync_cmd
+
+    async def run_async(self, job):
+        dests = self.destinations()
+        digest = await run_blocking(self.manifest_digest) if self.skip_unchanged else None
+        slots = asyncio.Semaphore(max(1, self.max_workers))
+
+        async def sync(dest):
+            async with slots:
+                return await self.sync(job, dest, digest)
+
+        results = await asyncio.gather(*[sync(dest) for dest in dests], return_exceptions=True)
+        failed = None
+        for dest, result in zip(dests, results):
+            if isinstance(result, BaseException):
+                failed = failed or result
+                self.result[dest] = {"ok": False}
+            else:
+                self.result[dest] = result
+        job.props.setdefault("rsync_stats", {}).update(self.result)
+        if failed:
+            raise failed
+
+    async def sync(self, job, dest, digest=None):
+        statefile = os.path.join(cache_dir("rsync"), hashlib.sha1(self.state_key(dest).encode("utf-8")).hexdigest())
+        if digest and os.path.exists(statefile):
+            with open(statefile) as f:
+                if f.read() == digest:
+                    job.log.info("{} is unchanged since the last sync to {}, skipping".format(self.src, dest), self)
+                    return {"ok": True, "skipped": True, "bytes_sent": 0, "duration": 0.0}
+
+        rsync_cmd = self.rsync_command(job, dest)
+        started = perf_counter()
+        returncode, output = await run_process(job, rsync_cmd, capture=True, check=False)
+        duration = perf_counter() - started
+        # written in one piece so output of concurrent transfers doesn't interleave
+        job.log.info(' '.join(rsync_cmd) + "\n" + output.decode("utf-8", "replace"), self)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, rsync_cmd, output)
+
+        if digest:
+            with open(statefile, "w") as f:
+                f.write(digest)
+        return {"ok": True, "skipped": False, "bytes_sent": self.parse_stat(output, b"Total bytes sent"),
+                "duration": duration}
+
+    def state_key(self, dest):
+        host = "{}@{}:{}".format(self.conn.username, self.conn.host, self.conn.port) if self.conn else ""
+        return host + " " + dest
+
+    @staticmethod
+    def parse_stat(output, name):
+        for line in output.splitlines():
+            if line.startswith(name + b":"):
+                return int(line.split(b":", 1)[1].split()[0].replace(b",", b""))
+
+    def manifest_digest(self):
+        """
+        Hash the source tree and the rsync options into one digest. In a persistent workspace, file content hashes are
+        cached by path, size and mtime so unchanged files aren't re-read on each run. Elsewhere the job's files are
+        fresh on every run, so there is nothing to reuse and no cache is kept.
+        """
+        src = os.path.abspath(self.src)
+        cachefile = None
+        cached = {}
+        if src.startswith(cache_dir("workspaces") + os.sep):
+            cachefile = os.path.join(cache_dir("rsync"), hashlib.sha1(src.encode("utf-8")).hexdigest() + ".manifest")
+            try:
+                with open(cachefile) as f:
+                    cached = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+        if os.path.isfile(src):
+            files = [src]
+        else:
+            files = sorted(os.path.join(root, name) for root, dirs, names in os.walk(src) for name in names)
+
+        manifest = {}
+        options = [self.src, self.compress, self.exclude, self.delete, self.flags]
+        digest = hashlib.sha256(json.dumps(options).encode("utf-8"))
+        for path in files:
+            st = os.lstat(path)
+            relpath = os.path.relpath(path, src)
+            entry = cached.get(relpath)
+            if not entry or entry[0] != st.st_size or entry[1] != st.st_mtime_ns:
+                entry = [st.st_size, st.st_mtime_ns, self.hash_file(path)]
+            manifest[relpath] = entry
+            digest.update("{}\0{}\0{}\n".format(relpath, entry[0], entry[2]).encode("utf-8"))
+
+        if cachefile:
+            with open(cachefile, "w") as f:
+                json.dump(manifest, f)
+        return digest.hexdigest()
+
+    @staticmethod
+    def hash_file(path):
+        if os.path.islink(path):
+            return "link:" + os.readlink(path)
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def __repr__(self):
+        return "<RsyncTask dest='{}'>".format(self.dest)
@@ -0,0 +1,298 @@
+import os
+import codecs
+import shlex
+import shutil
+import subprocess
+from tempfile import mkdtemp
+from threading import Lock
+from time import perf_counter
+from uuid import uuid4
+from shipper.lib import ShipperConnection, ShipperTask, run_blocking
+
+
+class SshConnection(ShipperConnection):
+    """
+    Connection description used for tasks reliant on SSH
+    """
+    def __init__(self, host, username, key=None, password=None, port=22):
+        self.host = host
+        self.username = username
+        self.key = os.path.abspath(key) if key else None
+        if key:
+            assert os.path.exists(key)
+        self.paramiko_key = None  # loaded on connect, rsync and git only hand the key file to ssh
+        self.password = password
+        self.port = port
+
+    def pool_key(self):
+        return (self.host, self.port, self.username, self.key)
+
+    def connect(self):
+        import paramiko
+        if self.key and self.paramiko_key is None:
+            self.paramiko_key = paramiko.RSAKey.from_private_key_file(self.key)
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.WarningPolicy)
+        connargs = {"pkey": self.paramiko_key} if self.paramiko_key else {"password": self.password}
+        client.connect(hostname=self.host, port=self.port, username=self.username, **connargs)
+        return client
+
+    def ssh_command(self, control_path=None):
+        """
+        Return an ssh command line suitable for rsync's -e or GIT_SSH_COMMAND. If `control_path` is given, the command
+        will share a multiplexed OpenSSH master connection with other commands using the same path.
+        """
+        cmd = "ssh"
+        if self.port != 22:
+            cmd += " -p {}".format(self.port)
+        if self.key:
+            cmd += " -i '{}'".format(self.key)
+        cmd += " -o StrictHostKeyChecking=no"
+        if control_path:
+            cmd += " -o ControlMaster=auto -o ControlPath='{}' -o ControlPersist=60".format(control_path)
+        return cmd
+
+
+class SshPool(object):
+    """
+    Authenticated SSH connections shared by the tasks of a job. Paramiko clients are keyed by the connection's host,
+    port, user and key, so tasks hitting the same host open new channels on one transport instead of handshaking again.
+    Subprocesses (rsync, git) share OpenSSH ControlMaster sockets in a private directory.
+    """
+    def __init__(self):
+        self.clients = {}
+        self.locks = {}
+        self.lock = Lock()
+        self.controldir = None
+
+    def client(self, conn):
+        key = conn.pool_key()
+        with self.lock:
+            keylock = self.locks.setdefault(key, Lock())
+        with keylock:
+            client = self.clients.get(key)
+            transport = client.get_transport() if client else None
+            if transport is None or not transport.is_active():
+                client = conn.connect()
+                self.clients[key] = client
+            return client
+
+    def control_path(self):
+        with self.lock:
+            if self.controldir is None:
+                self.controldir = mkdtemp(prefix="shipper-ssh-")
+            return os.path.join(self.controldir, "%C")
+
+    def close(self):
+        with self.lock:
+            clients = list(self.clients.values())
+            self.clients.clear()
+            controldir, self.controldir = self.controldir, None
+        for client in clients:
+            client.close()
+        if controldir:
+            for sock in os.listdir(controldir):
+                subprocess.call(["ssh", "-o", "ControlPath={}".format(os.path.join(controldir, sock)), "-O", "exit",
+                                 "shipper"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            shutil.rmtree(controldir, ignore_errors=True)
+
+
+class SshTask(ShipperTask):
+    """
+    Execute a command over SSH. Output is streamed to stdout as it arrives. If `check` is set, a non-zero exit status
+    raises CalledProcessError.
+    """
+    chunk_size = 32768
+
+    def __init__(self, command, connection=None, check=True):
+        super().__init__()
+        self.connection = connection
+        self.command = command
+        self.check = check
+
+    def validate(self, job):
+        self.conn = self.connection or job.props.get("connection")
+        assert self.conn
+
+    def run(self, job):
+        with self.open_channel(job) as chan:
+            status = self.finish(job, chan)
+        self.check_status(status)
+
+    async def run_async(self, job):
+        chan = await run_blocking(self.open_channel, job)
+        try:
+            status = await run_blocking(self.finish, job, chan)
+        finally:
+            chan.close()  # if cancelled, e.g. on a timeout, this also ends the wait of the thread reading it
+        self.check_status(status)
+
+    def open_channel(self, job):
+        chan = job.ssh.client(self.conn).get_transport().open_session()
+        chan.set_combine_stderr(True)
+        chan.get_pty()
+        chan.exec_command(self.command)
+        return chan
+
+    def finish(self, job, chan):
+        """
+        Stream the command's output until it exits and return its exit status
+        """
+        self.stream_output(job, chan)
+        return chan.recv_exit_status()
+
+    def check_status(self, status):
+        if status != 0 and self.check:
+            raise subprocess.CalledProcessError(status, self.command)
+
+    def stream_output(self, job, chan):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        while True:
+            chunk = chan.recv(self.chunk_size)
+            if not chunk:
+                break
+            job.log.write(decoder.decode(chunk))
+        job.log.write(decoder.decode(b"", final=True))
+
+    def __repr__(self):
+        return "<SshTask cmd='{}'>".format(self.command[0:50])
+
+
+class ScriptTask(SshTask):
+    """
+    Run a script on a remote host in one go: it is uploaded over SFTP on the job's pooled SSH connection and executed
+    with a single command, instead of opening a channel (and terminal) per command as a series of SshTasks would.
+
+    `script` is either the text of a script, run with its #! interpreter or `shell`, or a list of commands, each of
+    which is a step. Steps run in order in one shell, so `cd` and variables carry over, and the script stops at the
+    first failing step unless `keep_going` is set. The output of each step is logged under its command, and its exit
+    status and duration are kept in `self.result`. No terminal is allocated unless `pty` is set.
+    """
+    def __init__(self, script, connection=None, check=True, shell="/bin/sh", pty=False, keep_going=False,
+                 remote_dir="/tmp"):
+        super().__init__(None, connection, check)
+        self.script = script
+        self.steps = None if isinstance(script, str) else list(script)
+        self.shell = shell
+        self.pty = pty
+        self.keep_going = keep_going
+        self.remote_dir = remote_dir
+        self.marker = None
+        self.result = []
+
+    def validate(self, job):
+        assert self.script
+        super().validate(job)
+
+    def render(self, marker):
+        """
+        Return the script to upload. Steps are wrapped to print `marker` lines when they start and end, so their output
+        and exit status can be told apart.
+        """
+        if self.steps is None:
+            return self.script
+        lines = ["__shipper_status=0"]
+        for i, step in enumerate(self.steps):
+            lines += ["printf '%s start {}\\n' '{}'".format(i, marker),
+                      step,
+                      "__shipper_rc=$?",
+                      "printf '%s end {} %d\\n' '{}' $__shipper_rc".format(i, marker)]
+            if self.keep_going:
+                lines.append("[ $__shipper_rc -eq 0 ] || __shipper_status=$__shipper_rc")
+            else:
+                lines.append("[ $__shipper_rc -eq 0 ] || exit $__shipper_rc")
+        lines.append("exit $__shipper_status")
+        return "\n".join(lines) + "\n"
+
+    def open_channel(self, job):
+        """
+        Upload the script and start it. The script runs in the background while a watchdog reads the channel's stdin:
+        when the channel is closed before the script ends, e.g. as the task timed out, the watchdog kills the session's
+        processes, so a retry can't end up running alongside the previous attempt. The script's own stdin is /dev/null,
+        so commands reading it don't hang.
+        """
+        import paramiko
+        self.marker = "__shipper_{}__".format(uuid4().hex)
+        path = "{}/shipper-{}.sh".format(self.remote_dir.rstrip("/"), uuid4().hex)
+        script = self.render(self.marker)
+        interpreter = "" if script.startswith("#!") else "{} ".format(self.shell)
+        self.result = [{"step": step, "returncode": None, "duration": None} for step in self.steps or []]
+
+        transport = job.ssh.client(self.conn).get_transport()
+        sftp = paramiko.SFTPClient.from_transport(transport)
+        try:
+            with sftp.open(path, "w") as f:
+                f.write(script.encode("utf-8"))
+            sftp.chmod(path, 0o700)
+        finally:
+            sftp.close()
+
+        chan = transport.open_session()
+        chan.set_combine_stderr(True)
+        if self.pty:
+            chan.get_pty()
+        quoted = shlex.quote(path)
+        chan.exec_command("; ".join([
+            "exec 3<&0",
+            "{0}{1} 3<&- </dev/null & p=$!".format(interpreter, quoted),
+            "(cat <&3; rm -f {0}; kill -TERM 0) >/dev/null 2>&1 & w=$!".format(quoted),
+            "exec 3<&-",
+            "wait $p; rc=$?; kill $w 2>/dev/null; rm -f {0}; exit $rc".format(quoted)]))
+        return chan
+
+    def finish(self, job, chan):
+        unfinished = self.stream_output(job, chan, self.marker if self.steps is not None else None)
+        status = chan.recv_exit_status()
+        if unfinished is not None:  # the step ended the script itself, e.g. with `exit`
+            self.result[unfinished]["returncode"] = status
+        return status
+
+    def check_status(self, status):
+        if status != 0 and self.check:
+            failed = [r["step"] for r in self.result if r["returncode"] not in (None, 0)]
+            raise subprocess.CalledProcessError(status, failed[0] if failed else str(self))
+
+    def stream_output(self, job, chan, marker=None):
+        """
+        Log the script's output. With a `marker`, step boundaries are picked out of the output line by line, and the
+        step that was still running when the output ended, if any, is returned.
+        """
+        if marker is None:
+            return super().stream_output(job, chan)
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        started = None
+        current = None
+        partial = ""
+        while True:
+            chunk = chan.recv(self.chunk_size)
+            text = partial + decoder.decode(chunk, final=not chunk)
+            lines = text.splitlines(keepends=True)
+            partial = lines.pop() if chunk and lines and not lines[-1].endswith("\n") else ""
+            for line in lines:
+                pos = line.find(marker)
+                if pos < 0:
+                    job.log.write(line)
+                    continue
+                job.log.write(line[:pos])  # output of the step that didn't end with a newline
+                event, step, *rc = line[pos + len(marker):].split()
+                step = int(step)
+                if event == "start":
+                    started = perf_counter()
+                    current = step
+                    job.log.info("+ {}".format(self.steps[step]))
+                    job.log.emit("step", task=str(self), step=step, command=self.steps[step])
+                else:
+                    duration = perf_counter() - started
+                    current = None
+                    self.result[step].update(returncode=int(rc[0]), duration=duration)
+                    job.log.emit("step_end", task=str(self), step=step, returncode=int(rc[0]),
+                                 duration=round(duration, 4))
+                    if int(rc[0]) != 0:
+                        job.log.info("Step {} exited with status {}".format(step + 1, rc[0]))
+            if not chunk:
+                return current
+
+    def __repr__(self):
+        if self.steps is not None:
+            return "<ScriptTask steps={}>".format(len(self.steps))
+        return "<ScriptTask script='{}'>".format(self.script.strip().splitlines()[0][0:50])
@@ -0,0 +1,276 @@
+import os
+import re
+import json
+import hashlib
+from statistics import median
+from threading import Lock
+from shipper.cache import cache_dir
+
+
+def task_key(name):
+    """
+    Stable name of a task for looking up its past timings: function reprs lose their memory addresses
+    """
+    return re.sub(r" at 0x[0-9a-f]+", "", name)
+
+
+class TimingHistory(object):
+    """
+    Durations of the last `keep` successful runs of each task of each job, used to estimate runtimes in plans. Saved to
+    `path`, if given, whenever a job's timings are recorded.
+    """
+    def __init__(self, path=None, keep=20):
+        self.path = path
+        self.keep = keep
+        self.lock = Lock()
+        self.timings = self.load()
+
+    def load(self):
+        if self.path:
+            try:
+                with open(self.path) as f:
+                    return json.load(f)
+            except FileNotFoundError:
+                pass
+            except ValueError:
+                print("Ignoring corrupt timing history {}".format(self.path))
+        return {}
+
+    def record(self, jobname, timings):
+        with self.lock:
+            tasks = self.timings.setdefault(jobname, {})
+            for timing in timings:
+                if not timing.get("ok"):
+                    continue
+                durations = tasks.setdefault(task_key(timing["task"]), [])
+                durations.append(round(timing["duration"], 3))
+                del durations[:-self.keep]
+            if self.path:
+                tmp = self.path + ".tmp"
+                with open(tmp, "w") as f:
+                    json.dump(self.timings, f)
+                os.replace(tmp, self.path)
+
+    def estimate(self, jobname, task):
+        with self.lock:
+            durations = self.timings.get(jobname, {}).get(task)
+            return median(durations) if durations else None
+
+
+def plan_job(job, params=None):
+    """
+    Resolve the steps `job` would run with `params`, without running any of them. LambdaTasks are expanded by calling
+    their function against a scratch copy of the job; ones that fail, e.g. because they need props set by an earlier
+    task, are reported with their error.
+    """
+    from shipper.lib import ShipperJob
+    scratch = ShipperJob()
+    scratch.props.update(job.props)
+    scratch.props.update(params or {})
+    steps, _ = plan_steps(job.tasks, scratch, top=True)
+    return steps
+
+
+def plan_steps(tasks, scratch, top=False, generated=False):
+    """
+    Plan a list of tasks run in order, as the job's own list or a SerialTask's. Steps generated by LambdaTasks in the
+    list are inserted after them, as when running. Steps generated by LambdaTasks inside a ParallelTask are inserted
+    into the job's list, so unless this is it (`top`) they are returned to be planned there. Steps of the job's list
+    that wait for others (see ShipperJob.add_task) list their numbers in "after".
+    """
+    steps = []
+    spill = []
+    numbers = {}
+    pending = [(task, generated) for task in tasks]
+    while pending:
+        task, gen = pending.pop(0)
+        step, inline, later = plan_step(task, scratch, gen)
+        steps.append(step)
+        numbers[task] = len(steps)
+        if top and getattr(task, "after", None):
+            step["after"] = [numbers[other] for other in task.after if other in numbers]
+        if top:
+            inline = inline + later
+        else:
+            spill += later
+        pending[0:0] = [(t, True) for t in inline]
+    return steps, spill
+
+
+def plan_step(task, scratch, generated):
+    """
+    Describe `task`. Returns the step, the tasks it generates in its own list and those it generates in the job's list.
+    """
+    from shipper.lib import LambdaTask, ParallelTask, SerialTask
+    step = {"task": task_key(str(task)), "class": type(task).__name__}
+    conn = getattr(task, "conn", None) or getattr(task, "connection", None)
+    if getattr(conn, "host", None):
+        step["connection"] = "{}@{}:{}".format(conn.username, conn.host, conn.port)
+    if getattr(task, "timeout", None):
+        step["timeout"] = task.timeout
+    if getattr(task, "retry", None):
+        step["attempts"] = task.retry.attempts
+    if getattr(task, "overlap", False):
+        step["overlap"] = True
+    if generated:
+        step["generated"] = True
+
+    if isinstance(task, LambdaTask):
+        try:
+            newsteps = list(task.func(scratch) or [])
+            for newstep in newsteps:
+                newstep.validate(scratch)
+        except Exception as e:
+            step["error"] = "{}: {}".format(type(e).__name__, e)
+            return step, [], []
+        return step, newsteps, []
+    if isinstance(task, ParallelTask):
+        step["parallel"] = True
+        step["steps"] = []
+        later = []
+        for child in task.tasks:
+            childstep, inline, childlater = plan_step(child, scratch, generated)
+            step["steps"].append(childstep)
+            later += inline + childlater
+        return step, [], later
+    if isinstance(task, SerialTask):
+        step["steps"], later = plan_steps(task.tasks, scratch, generated=generated)
+        return step, [], later
+    return step, [], []
+
+
+class Planner(object):
+    """
+    Builds plans of job files: their settings and the steps a run would take, with runtimes estimated from `history`.
+    Resolved steps are cached in `cachedir` keyed by the job file's hash and the params, so a job file is only loaded
+    and its LambdaTasks called again once it changes. Estimates are filled in on every call.
+    """
+    def __init__(self, history=None, cachedir=None, max_entries=1000):
+        self.history = history
+        self.cachedir = cachedir
+        self.max_entries = max_entries
+
+    def cachepath(self, digest, params):
+        key = hashlib.sha256(json.dumps([digest, params], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        return os.path.join(self.cachedir or cache_dir("plans"), key + ".json")
+
+    def plan(self, registry, taskname, params=None, refresh=False):
+        """
+        Plan job file `taskname` of `registry`. Raises FileNotFoundError if it doesn't exist; if it can't be loaded
+        the plan has `valid` unset and the `error`.
+        """
+        with open(registry.path(taskname), "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        path = self.cachepath(digest, params)
+        plan = None
+        if not refresh:
+            try:
+                with open(path) as f:
+                    plan = json.load(f)
+                plan["cached"] = True
+            except (OSError, ValueError):
+                pass
+        if plan is None:
+            plan = self.resolve(registry, taskname, params)
+            if plan["valid"]:
+                self.save(self.cachepath(plan["digest"], params), plan)
+        if plan["valid"]:
+            self.estimate(plan)
+        return plan
+
+    def resolve(self, registry, taskname, params):
+        try:
+            task = registry.get(taskname)
+            steps = plan_job(task.job, params)
+        except FileNotFoundError:
+            raise
+        except Exception as e:
+            # no traceback: plans of job files that can't be loaded, and so authorized, are served to anyone
+            return {"job": taskname, "valid": False, "error": "{}: {}".format(type(e).__name__, e)}
+        return {"job": taskname, "valid": True, "digest": task.digest, "cached": False, "lane": task.lane,
+                "priority": task.priority, "timeout": task.timeout, "requires": task.requires, "hosts": task.hosts,
+                "schedule": task.schedule, "resumable": task.resumable, "steps": steps}
+
+    def save(self, path, plan):
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(plan, f)
+        os.replace(tmp, path)
+        entries = sorted(os.scandir(os.path.dirname(path)), key=lambda e: e.stat().st_mtime)
+        for entry in entries[:max(0, len(entries) - self.max_entries)]:
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def estimate(self, plan):
+        """
+        Fill in the estimated runtime of each step and of the whole job. Groups without their own history are
+        estimated from their steps. Steps that never ran successfully, so can't be estimated, are counted in `unknown`.
+        """
+        def fill(step):
+            children = [fill(s) for s in step.get("steps", [])]
+            estimate = self.history.estimate(plan["job"], step["task"]) if self.history else None
+            if estimate is None and children and None not in children:
+                estimate = max(children) if step.get("parallel") else sum(children)
+            step["estimate"] = estimate
+            return estimate
+
+        estimates = [fill(step) for step in plan["steps"]]
+        clock = end = 0  # overlapping steps run alongside the ones after them
+        finish = {}
+        for number, (step, estimate) in enumerate(zip(plan["steps"], estimates), 1):
+            if estimate is None:
+                continue
+            start = max([clock] + [finish[other] for other in step.get("after", []) if other in finish])
+            finish[number] = start + estimate
+            if not step.get("overlap"):
+                clock = finish[number]
+            end = max(end, finish[number])
+        plan["estimate"] = end
+        plan["unknown"] = estimates.count(None)
+
+
+def render_plan(plan):
+    """
+    Format a plan for the terminal
+    """
+    lines = ["Plan for {}".format(plan["job"])]
+    if not plan["valid"]:
+        lines.append("Invalid job file: {}".format(plan["error"]))
+        return "\n".join(lines)
+    settings = ["{}={}".format(k, plan[k]) for k in ("lane", "priority", "timeout", "requires", "schedule")
+                if plan.get(k)]
+    if plan.get("resumable"):
+        settings.append("resumable")
+    if settings:
+        lines.append("  " + ", ".join(settings))
+
+    def render(steps, depth):
+        for i, step in enumerate(steps, 1):
+            details = [step[k] for k in ("connection", ) if step.get(k)]
+            if step.get("timeout"):
+                details.append("timeout {}s".format(step["timeout"]))
+            if step.get("attempts"):
+                details.append("{} attempts".format(step["attempts"]))
+            if step.get("overlap"):
+                details.append("overlapping")
+            if step.get("after"):
+                details.append("after {}".format(", ".join(str(number) for number in step["after"])))
+            if step.get("generated"):
+                details.append("generated")
+            details.append("~{:.1f}s".format(step["estimate"]) if step.get("estimate") is not None else "no history")
+            lines.append("{}{}. {}  ({})".format("   " * depth + "  ", i, step["task"], ", ".join(details)))
+            if step.get("error"):
+                lines.append("{}   could not expand: {}".format("   " * depth + "  ", step["error"]))
+            render(step.get("steps", []), depth + 1)
+
+    render(plan["steps"], 0)
+    if plan["unknown"] == len(plan["steps"]):
+        total = "No timing history to estimate the runtime from"
+    else:
+        total = "Estimated runtime: ~{:.1f}s".format(plan["estimate"])
+        if plan["unknown"]:
+            total += ", plus {} steps without history".format(plan["unknown"])
+    lines.append(total + (" (cached plan)" if plan.get("cached") else ""))
+    return "\n".join(lines)
@@ -0,0 +1,158 @@
+import os
+import hashlib
+import importlib.util
+from threading import Lock
+from time import time, monotonic
+
+
+class TaskLoadError(Exception):
+    pass
+
+
+def job_hosts(job):
+    """
+    Return the sorted remote hosts the tasks of `job` connect to, descending into task groups
+    """
+    hosts = set()
+    default = getattr(job, "props", {}).get("connection")
+    pending = list(getattr(job, "tasks", None) or [])
+    while pending:
+        task = pending.pop()
+        pending.extend(getattr(task, "tasks", None) or [])
+        if not hasattr(task, "connection"):
+            continue
+        host = getattr(task.connection or default, "host", None)
+        if host:
+            hosts.add(host)
+    return sorted(hosts)
+
+
+class LoadedTask(object):
+    """
+    A compiled and executed task file plus the metadata extracted from it
+    """
+    def __init__(self, name, path, stat, digest, code, module):
+        self.name = name
+        self.path = path
+        self.stat = stat
+        self.digest = digest
+        self.code = code
+        self.module = module
+        self.job = getattr(module, "job", None)
+        self.auth = None
+        if hasattr(module, "auth"):
+            self.auth = frozenset(tuple(pair) for pair in module.auth)
+        # queueing policy: "latest" drops queued runs of the same task & branch when a newer one arrives, debounce
+        # delays runs by that many seconds (implies "latest"), concurrency caps simultaneous runs of the task
+        self.coalesce = getattr(module, "coalesce", None)
+        self.debounce = getattr(module, "debounce", None)
+        self.concurrency = getattr(module, "concurrency", None)
+        # scheduling: runs start in `priority` order within the limits of their `lane` and of the hosts they target
+        self.lane = getattr(module, "lane", None)
+        self.priority = getattr(module, "priority", None)
+        self.hosts = job_hosts(self.job) if self.job is not None else []
+        # limits: runs are killed after `timeout` seconds, cpu_limit and memory_limit are applied as rlimits
+        self.timeout = getattr(module, "timeout", None)
+        # labels a worker must have to run the job, e.g. ["docker"]
+        self.requires = list(getattr(module, "requires", None) or [])
+        # failed runs keep their workspace and progress so they can be resumed from the failing task
+        self.resumable = bool(getattr(module, "resumable", False))
+        # periodic runs: a cron expression or interval in seconds, and what to do about runs missed while down
+        self.schedule = getattr(module, "schedule", None)
+        self.catchup = getattr(module, "catchup", None)
+        self.checked = monotonic()
+
+    def validate(self):
+        if self.job is None:
+            raise TaskLoadError("{} does not define a 'job'".format(self.path))
+        if not isinstance(getattr(self.job, "tasks", None), list):
+            raise TaskLoadError("{}: 'job' has no task list".format(self.path))
+        if self.auth is not None and any(len(pair) != 2 for pair in self.auth):
+            raise TaskLoadError("{}: 'auth' must contain (username, password) pairs".format(self.path))
+        if self.coalesce not in (None, "latest"):
+            raise TaskLoadError("{}: unknown coalesce policy {!r}".format(self.path, self.coalesce))
+        if self.debounce is not None and self.debounce < 0:
+            raise TaskLoadError("{}: 'debounce' must not be negative".format(self.path))
+        if self.concurrency is not None and self.concurrency < 1:
+            raise TaskLoadError("{}: 'concurrency' must be at least 1".format(self.path))
+        if self.lane is not None and not isinstance(self.lane, str):
+            raise TaskLoadError("{}: 'lane' must be a string".format(self.path))
+        if self.priority is not None and not isinstance(self.priority, int):
+            raise TaskLoadError("{}: 'priority' must be an integer".format(self.path))
+        if not all(isinstance(label, str) for label in self.requires):
+            raise TaskLoadError("{}: 'requires' must be a list of labels".format(self.path))
+        for name in ("timeout", "cpu_limit", "memory_limit"):
+            value = getattr(self.module, name, None)
+            if value is not None and (not isinstance(value, (int, float)) or value <= 0):
+                raise TaskLoadError("{}: '{}' must be a positive number".format(self.path, name))
+        if self.schedule is not None:
+            from shipper.scheduler import parse_schedule, CATCHUP_POLICIES
+            try:
+                parse_schedule(self.schedule).next_after(time())  # e.g. "0 0 31 2 *" parses but never matches
+            except ValueError as e:
+                raise TaskLoadError("{}: {}".format(self.path, e))
+            if self.catchup not in (None, ) + CATCHUP_POLICIES:
+                raise TaskLoadError("{}: 'catchup' must be one of {}".format(self.path, ", ".join(CATCHUP_POLICIES)))
+        if getattr(self.module, "workspace", None) not in (None, "persistent"):
+            raise TaskLoadError("{}: 'workspace' must be \"persistent\" if set".format(self.path))
+
+
+class TaskRegistry(object):
+    """
+    Cache of loaded task files, keyed by path. Files are re-stat'd at most once every `poll_interval` seconds and only
+    recompiled and re-executed when their size, mtime or content hash changes.
+    """
+    def __init__(self, basedir="./", poll_interval=1.0):
+        self.basedir = basedir
+        self.poll_interval = poll_interval
+        self.tasks = {}
+        self.lock = Lock()
+
+    def path(self, taskname):
+        return os.path.join(self.basedir, taskname + ".py")
+
+    def get(self, taskname):
+        """
+        Return the LoadedTask for `taskname`, loading it if it is not cached or has changed on disk. Raises
+        FileNotFoundError if the task file does not exist.
+        """
+        with self.lock:
+            cached = self.tasks.get(taskname)
+            if cached and monotonic() - cached.checked < self.poll_interval:
+                return cached
+            path = self.path(taskname)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                self.tasks.pop(taskname, None)
+                raise
+            stat = (st.st_mtime_ns, st.st_size)
+            if cached and cached.stat == stat:
+                cached.checked = monotonic()
+                return cached
+            loaded = self.load(taskname, path, stat, cached)
+            self.tasks[taskname] = loaded
+            return loaded
+
+    def load(self, taskname, path, stat, cached=None):
+        with open(path, "rb") as f:
+            source = f.read()
+        digest = hashlib.sha256(source).hexdigest()
+        if cached and cached.digest == digest:  # touched but not modified
+            cached.stat = stat
+            cached.checked = monotonic()
+            return cached
+        code = compile(source, path, "exec")
+        spec = importlib.util.spec_from_file_location("job", path)
+        module = importlib.util.module_from_spec(spec)
+        exec(code, module.__dict__)
+        loaded = LoadedTask(taskname, path, stat, digest, code, module)
+        loaded.validate()
+        return loaded
+
+    def invalidate(self, taskname=None):
+        with self.lock:
+            if taskname is None:
+                self.tasks.clear()
+            else:
+                self.tasks.pop(taskname, None)
@@ -1,32 +1,254 @@
 #!/usr/bin/env python3
 import os
-import importlib
+import sys
+import signal
+import resource
+import importlib.util
 import argparse
 import json
+import shutil
+import traceback
+from contextlib import contextmanager
 from tempfile import TemporaryDirectory
 
 
-def load_task(srcfile):
+def load_task(srcfile, code=None):
     spec = importlib.util.spec_from_file_location("job", srcfile)
     job = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(job)
+    if code is None:
+        spec.loader.exec_module(job)
+    else:
+        exec(code, job.__dict__)
     return job
 
 
+def redirect_output(logfile):
+    """
+    Point stdout and stderr, including those of any subprocesses, at `logfile`
+    """
+    fd = os.open(logfile, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+
+
+def terminated(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+def apply_limits(job):
+    """
+    Apply the job file's `cpu_limit` (seconds of CPU time) and `memory_limit` (bytes of address space) to this process.
+    The limits are inherited by, and apply separately to, every process the job starts.
+    """
+    for name, limit in (("cpu_limit", resource.RLIMIT_CPU), ("memory_limit", resource.RLIMIT_AS)):
+        value = getattr(job, name, None)
+        if value:
+            resource.setrlimit(limit, (int(value), resource.getrlimit(limit)[1]))
+
+
+def run_job(jobfile, params, code=None, statsfile=None, statedir=None, eventsfile=None, own_group=False):
+    # exit cleanly when cancelled or timed out so connections are closed and timings are still written
+    signal.signal(signal.SIGTERM, terminated)
+    job = load_task(jobfile, code)
+    apply_limits(job)
+    if not getattr(job, "resumable", False):
+        statedir = None
+    # output, including that of print() in the job file, is written out in batches by the job log, frequently enough
+    # that the log can still be followed while the job runs
+    from shipper.joblog import JobLog
+    sys.stdout.flush()
+    log = JobLog(eventsfile, textfd=sys.stdout.fileno())
+    job.job.log = log
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = log.stream()
+    error = None
+    try:
+        with workspace(job, jobfile, statedir):
+            checkpoint = None
+            if statedir:
+                from shipper.lib import Checkpoint
+                os.makedirs(statedir, exist_ok=True)  # a persistent workspace doesn't live in it
+                checkpoint = Checkpoint(os.path.join(statedir, "checkpoint.json"))
+            job.job.run(params, checkpoint)
+        if statedir:  # only failed runs are kept around to be resumed
+            shutil.rmtree(statedir, ignore_errors=True)
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        log.close(error)
+        sys.stdout, sys.stderr = stdout, stderr
+        if statsfile:
+            write_stats(job.job, statsfile)
+        if own_group:
+            kill_leftovers()
+
+
+def kill_leftovers():
+    """
+    Kill processes the job left behind, e.g. the children of a command whose task timed out. Only for runners the
+    server started in a process group of their own: otherwise the group may be a shell pipeline runjob.py is part of.
+    """
+    if os.getpgrp() != os.getpid():
+        return
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    os.killpg(0, signal.SIGTERM)
+
+
+@contextmanager
+def workspace(job, jobfile, statedir=None):
+    """
+    Run the job in a fresh temporary dir, or, if the job file sets `workspace = "persistent"`, in a dir that is kept
+    between runs of the job. Runs sharing a persistent workspace are serialized with a lock. Resumable jobs work in a
+    dir under their `statedir` so a resumed run finds the files the failed one left.
+    """
+    if getattr(job, "workspace", None) == "persistent":
+        from shipper.cache import cache_dir, locked
+        path = cache_dir("workspaces", os.path.splitext(os.path.basename(jobfile))[0])
+        with locked(path + ".lock"):
+            os.chdir(path)
+            yield path
+    elif statedir:
+        path = os.path.join(statedir, "workspace")
+        os.makedirs(path, exist_ok=True)
+        os.chdir(path)
+        try:
+            yield path
+        finally:
+            os.chdir("/")
+    else:
+        with TemporaryDirectory() as d:
+            os.chdir(d)
+            yield d
+
+
+def write_stats(job, statsfile):
+    """
+    Write the job's task timings to `statsfile` for the server to pick up
+    """
+    with open(statsfile, "w") as f:
+        json.dump({"tasks": job.timings}, f)
+
+
+def plan(jobfile, params, history=None, refresh=False):
+    """
+    Print the plan of `jobfile`. Returns the exit status: 1 if the job file is invalid.
+    """
+    from shipper.registry import TaskRegistry
+    from shipper.plan import Planner, TimingHistory, render_plan
+    jobfile = os.path.abspath(jobfile)
+    registry = TaskRegistry(os.path.dirname(jobfile))
+    planner = Planner(TimingHistory(history) if history else None)
+    result = planner.plan(registry, os.path.splitext(os.path.basename(jobfile))[0], params, refresh)
+    print(render_plan(result))
+    return 0 if result["valid"] else 1
+
+
+def compile_task(srcfile, cache):
+    """
+    Return the compiled code of `srcfile`, reusing the cached code object if the file has not changed
+    """
+    st = os.stat(srcfile)
+    key = (st.st_mtime_ns, st.st_size)
+    cached = cache.get(srcfile)
+    if cached and cached[0] == key:
+        return cached[1]
+    with open(srcfile, "rb") as f:
+        code = compile(f.read(), srcfile, "exec")
+    cache[srcfile] = (key, code)
+    return code
+
+
+def exit_code(status):
+    """
+    Decode a status from os.waitpid() the way subprocess does: the exit status, or the negated signal number
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def serve(resultfd):
+    """
+    Warm runner mode. Heavy dependencies are imported once up front, then job requests are read from stdin as JSON lines
+    and each one is run in a forked child. Status messages are written to `resultfd` as JSON lines.
+    """
+    import shipper.lib
+    shipper.lib.preload()  # paramiko, GitPython etc, so forked jobs don't each pay for importing them
+
+    results = os.fdopen(resultfd, "w", buffering=1)
+    codecache = {}
+
+    for line in sys.stdin:
+        request = json.loads(line)
+        try:
+            code = compile_task(request["jobfile"], codecache)
+        except Exception:
+            traceback.print_exc()
+            results.write(json.dumps({"returncode": 1}) + "\n")
+            continue
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            returncode = 0
+            try:
+                os.setsid()  # own process group, so the server can kill the job and everything it starts
+                os.close(0)
+                results.close()
+                if request.get("log"):
+                    redirect_output(request["log"])
+                run_job(request["jobfile"], request["params"], code, request.get("stats"), request.get("state"),
+                        request.get("events"), own_group=True)
+            except SystemExit as e:
+                returncode = e.code if isinstance(e.code, int) else 1
+            except BaseException:
+                traceback.print_exc()
+                returncode = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(returncode)
+
+        results.write(json.dumps({"pid": pid}) + "\n")
+        _, status = os.waitpid(pid, 0)
+        results.write(json.dumps({"returncode": exit_code(status)}) + "\n")
+
+
 def main():
     parser = argparse.ArgumentParser(description="Shipper task runner")
 
-    parser.add_argument('jobfile', help="Job file to run")
-    parser.add_argument('args', help="JSON args")
+    parser.add_argument('jobfile', nargs="?", help="Job file to run")
+    parser.add_argument('args', nargs="?", help="JSON args")
+    parser.add_argument('--stats', help="write task timings to this file as JSON")
+    parser.add_argument('--state', help="dir to keep a resumable job's workspace and checkpoint in")
+    parser.add_argument('--events', help="write structured log events to this file, gzipped if it ends in .gz")
+    parser.add_argument('--own-group', action="store_true",
+                        help="the runner leads a process group of its own: kill whatever the job left running in it")
+    parser.add_argument('--plan', action="store_true",
+                        help="print the steps the job would run, with estimated runtimes, instead of running it")
+    parser.add_argument('--history', help="timing history to estimate runtimes from, e.g. the server's "
+                                          "logs/timings.json")
+    parser.add_argument('--no-cache', action="store_true", help="with --plan, don't use a cached plan")
+    parser.add_argument('--serve', type=int, metavar="FD",
+                        help="run as a warm runner, reading jobs from stdin and writing results to FD")
 
     args = parser.parse_args()
 
-    job = load_task(args.jobfile)
-    params = json.loads(args.args)
+    if args.serve is not None:
+        serve(args.serve)
+        return
+
+    if args.plan and args.jobfile:
+        sys.exit(plan(args.jobfile, json.loads(args.args or "{}"), args.history, args.no_cache))
+
+    if not args.jobfile or args.args is None:
+        parser.error("jobfile and args are required")
 
-    with TemporaryDirectory() as d:
-        os.chdir(d)
-        job.job.run(params)
+    run_job(args.jobfile, json.loads(args.args), statsfile=args.stats, statedir=args.state, eventsfile=args.events,
+            own_group=args.own_group)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,194 @@
+import os
+import sys
+import json
+import queue
+import signal
+import subprocess
+from threading import Lock, Timer
+
+
+def kill_group(pgid, grace=10):
+    """
+    Send SIGTERM to process group `pgid` - a job's runner plus any git, rsync or ssh processes it started - and SIGKILL
+    to whatever is left of it `grace` seconds later
+    """
+    def signal_group(signum):
+        try:
+            os.killpg(pgid, signum)
+        except ProcessLookupError:
+            pass
+    signal_group(signal.SIGTERM)
+    t = Timer(grace, signal_group, (signal.SIGKILL, ))
+    t.daemon = True
+    t.start()
+
+
+class SpawnRunner(object):
+    """
+    Run each job in a freshly started python interpreter
+    """
+    def __init__(self, runnerpath, kill_grace=10):
+        self.runnerpath = runnerpath
+        self.kill_grace = kill_grace
+        self.active = {}
+        self.lock = Lock()
+
+    def run(self, job, logfile=None, statsfile=None, statedir=None, eventsfile=None):
+        cmd = [sys.executable, self.runnerpath, job.name + ".py", json.dumps(job.args), "--own-group"]
+        if statsfile:
+            cmd += ["--stats", statsfile]
+        if statedir:
+            cmd += ["--state", statedir]
+        if eventsfile:
+            cmd += ["--events", eventsfile]
+        log = open(logfile, "ab") if logfile else None
+        try:
+            # each job gets its own process group so killing it also kills whatever it spawned
+            p = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT if log else None, start_new_session=True)
+            with self.lock:
+                self.active[job.id] = p.pid
+            try:
+                return p.wait()
+            finally:
+                with self.lock:
+                    del self.active[job.id]
+        finally:
+            if log:
+                log.close()
+
+    def kill(self, job):
+        """
+        Kill the running `job`. Returns False if it isn't running.
+        """
+        with self.lock:
+            pid = self.active.get(job.id)
+        if pid is None:
+            return False
+        kill_group(pid, self.kill_grace)
+        return True
+
+    def close(self):
+        pass
+
+
+class WarmProcess(object):
+    """
+    A runjob.py process started in --serve mode. It has already imported shipper.lib and forks once per job.
+    """
+    def __init__(self, runnerpath):
+        rfd, wfd = os.pipe()
+        try:
+            self.proc = subprocess.Popen([sys.executable, runnerpath, "--serve", str(wfd)],
+                                         stdin=subprocess.PIPE, pass_fds=(wfd, ), universal_newlines=True)
+        finally:
+            os.close(wfd)
+        self.results = os.fdopen(rfd, "r")
+        self.pid = None
+        self.running = False  # from sending a job until its returncode arrives
+        self.kill_grace = None
+        self.lock = Lock()
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def run(self, job, logfile=None, statsfile=None, statedir=None, eventsfile=None):
+        with self.lock:
+            self.running = True
+            self.kill_grace = None
+        self.proc.stdin.write(json.dumps({"jobfile": job.name + ".py", "params": job.args, "log": logfile,
+                                          "stats": statsfile, "state": statedir, "events": eventsfile}) + "\n")
+        self.proc.stdin.flush()
+        while True:
+            line = self.results.readline()
+            if not line:
+                raise Exception("warm runner {} exited unexpectedly".format(self.proc.pid))
+            msg = json.loads(line)
+            if "pid" in msg:
+                with self.lock:
+                    self.pid = msg["pid"]
+                    if self.kill_grace is not None:  # killed before the job had started
+                        kill_group(self.pid, self.kill_grace)
+            if "returncode" in msg:
+                with self.lock:
+                    self.pid = None
+                    self.running = False
+                    self.kill_grace = None
+                return msg["returncode"]
+
+    def kill(self, grace):
+        """
+        Kill the job this process is currently running, including everything it spawned. Calls that arrive after the
+        job finished are ignored, so they can't hit the next job.
+        """
+        with self.lock:
+            if not self.running:
+                return
+            self.kill_grace = grace
+            if self.pid:
+                kill_group(self.pid, grace)
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+        self.results.close()
+
+
+class WarmRunner(object):
+    """
+    Run jobs on a pool of pre-started runner processes
+    """
+    def __init__(self, runnerpath, size=5, kill_grace=10):
+        self.runnerpath = runnerpath
+        self.kill_grace = kill_grace
+        self.idle = queue.Queue()
+        self.procs = []
+        self.active = {}
+        self.lock = Lock()
+        for _ in range(size):
+            self.idle.put(self.spawn())
+
+    def spawn(self):
+        proc = WarmProcess(self.runnerpath)
+        with self.lock:
+            self.procs.append(proc)
+        return proc
+
+    def discard(self, proc):
+        with self.lock:
+            self.procs.remove(proc)
+        proc.proc.kill()
+        proc.proc.wait()
+        proc.results.close()
+
+    def run(self, job, logfile=None, statsfile=None, statedir=None, eventsfile=None):
+        proc = self.idle.get()
+        with self.lock:
+            self.active[job.id] = proc
+        try:
+            return proc.run(job, logfile, statsfile, statedir, eventsfile)
+        except Exception:
+            self.discard(proc)
+            proc = self.spawn()
+            raise
+        finally:
+            with self.lock:
+                del self.active[job.id]
+            self.idle.put(proc)
+
+    def kill(self, job):
+        """
+        Kill the running `job`. Returns False if it isn't running.
+        """
+        with self.lock:
+            proc = self.active.get(job.id)
+        if proc is None:
+            return False
+        proc.kill(self.kill_grace)
+        return True
+
+    def close(self):
+        with self.lock:
+            procs = list(self.procs)
+        for proc in procs:
+            proc.close()
+
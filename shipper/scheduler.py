@@ -0,0 +1,261 @@
+import os
+import json
+import heapq
+import traceback
+from datetime import datetime, timedelta
+from threading import Thread, Condition
+from time import time
+from shipper.jobqueue import QueueFull
+from shipper.registry import TaskLoadError
+
+
+CATCHUP_POLICIES = ("skip", "once", "all")
+MAX_CATCHUP = 100  # runs queued at most per schedule when catching up with catchup = "all"
+
+
+class CronSpec(object):
+    """
+    A standard 5 field cron expression - minute, hour, day of month, month and day of week - supporting `*`, lists,
+    ranges and steps. Times are in local time.
+    """
+    ranges = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))  # sunday is 0 or 7
+
+    def __init__(self, expr):
+        self.expr = expr
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError("cron expression should have 5 fields, got '{}'".format(expr))
+        self.minutes, self.hours, self.days, self.months, self.weekdays = \
+            [self.parse_field(field, lo, hi) for field, (lo, hi) in zip(fields, self.ranges)]
+        # as in cron, when both day fields are restricted a day matching either one matches
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    @staticmethod
+    def parse_field(field, lo, hi):
+        values = set()
+        for part in field.split(","):
+            rng, _, step = part.partition("/")
+            step = int(step) if step else 1
+            if rng == "*":
+                start, end = lo, hi
+            elif "-" in rng:
+                start, end = (int(i) for i in rng.split("-", 1))
+            else:
+                start = int(rng)
+                end = hi if step > 1 else start
+            if start < lo or end > hi or start > end or step < 1:
+                raise ValueError("invalid cron field '{}'".format(field))
+            values.update(range(start, end + 1, step))
+        if hi == 7:
+            values = {v % 7 for v in values}
+        return frozenset(values)
+
+    def day_matches(self, dt):
+        day = dt.day in self.days
+        weekday = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, ts):
+        """
+        Return the first matching time after timestamp `ts`
+        """
+        dt = datetime.fromtimestamp(ts).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt + timedelta(days=366 * 5)
+        while dt < limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            elif not self.day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt.timestamp()
+        raise ValueError("cron expression '{}' never matches".format(self.expr))
+
+
+class IntervalSpec(object):
+    """
+    Every `seconds` seconds, counted from the epoch so runs land on the same times across restarts
+    """
+    def __init__(self, seconds):
+        if seconds <= 0:
+            raise ValueError("schedule interval must be positive")
+        self.seconds = seconds
+
+    def next_after(self, ts):
+        return (ts // self.seconds + 1) * self.seconds
+
+
+def parse_schedule(schedule):
+    """
+    Parse a job file's `schedule`: a cron expression, or an interval in seconds
+    """
+    if isinstance(schedule, (int, float)) and not isinstance(schedule, bool):
+        return IntervalSpec(schedule)
+    if isinstance(schedule, str):
+        return CronSpec(schedule)
+    raise ValueError("schedule must be a cron expression or a number of seconds")
+
+
+class Schedule(object):
+    def __init__(self, taskname, spec, catchup="skip", digest=None):
+        self.taskname = taskname
+        self.spec = spec
+        self.catchup = catchup
+        self.digest = digest
+        self.due = None
+        self.last = None  # the job queued by the last run
+
+    def running(self):
+        return self.last is not None and self.last.finished is None
+
+
+class Scheduler(object):
+    """
+    Queues runs of job files that declare a `schedule`. Pending runs are kept in a heap ordered by due time and a single
+    thread sleeps until the earliest one, so any number of schedules costs one thread. The task dir is rescanned every
+    `rescan_interval` seconds to pick up added, changed and removed schedules.
+
+    A run is skipped if the previous run of the same job is still queued or running. The time of the last run of each
+    schedule is saved to `statefile`; runs missed while the server was down are handled according to the job file's
+    `catchup` policy: "skip" them (the default), queue "once" or queue "all" of them.
+    """
+    def __init__(self, executor, statefile=None, rescan_interval=60):
+        self.executor = executor
+        self.registry = executor.registry
+        self.statefile = statefile
+        self.rescan_interval = rescan_interval
+        self.schedules = {}
+        self.heap = []
+        self.seq = 0
+        self.lastrun = self.load_state()
+        self.cond = Condition()
+        self.closed = False
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def load_state(self):
+        if self.statefile:
+            try:
+                with open(self.statefile) as f:
+                    return json.load(f)
+            except FileNotFoundError:
+                pass
+            except ValueError:
+                print("Ignoring corrupt schedule state file {}".format(self.statefile))
+        return {}
+
+    def save_state(self):
+        if not self.statefile:
+            return
+        tmp = self.statefile + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.lastrun, f)
+        os.replace(tmp, self.statefile)
+
+    def scan(self):
+        """
+        Load every job file in the task dir and (re)schedule those with a `schedule`
+        """
+        seen = set()
+        for filename in sorted(os.listdir(self.registry.basedir)):
+            taskname, ext = os.path.splitext(filename)
+            if ext != ".py":
+                continue
+            try:
+                task = self.registry.get(taskname)
+            except OSError:
+                continue
+            except TaskLoadError as e:
+                print("Not scheduling {}: {}".format(filename, e))
+                continue
+            except Exception:
+                print("Could not load {} to check for a schedule:\n{}".format(filename, traceback.format_exc()))
+                continue
+            if task.schedule is None:
+                continue
+            seen.add(taskname)
+            current = self.schedules.get(taskname)
+            if current and current.digest == task.digest:
+                continue
+            schedule = Schedule(taskname, parse_schedule(task.schedule), task.catchup or "skip", task.digest)
+            if current:
+                schedule.last = current.last
+            try:
+                self.add(schedule, catchup=current is None)
+            except Exception:
+                # one bad schedule mustn't stop the others. It stays registered without a due time, so the file is
+                # only tried again once it changes.
+                print("Could not schedule {}:\n{}".format(filename, traceback.format_exc()))
+        for taskname in set(self.schedules) - seen:
+            print("Unscheduled {}".format(taskname))
+            del self.schedules[taskname]
+
+    def add(self, schedule, catchup=True):
+        now = time()
+        self.schedules[schedule.taskname] = schedule
+        last = self.lastrun.get(schedule.taskname)
+        if catchup and last is not None:
+            missed = []
+            due = schedule.spec.next_after(last)
+            while due <= now and len(missed) < MAX_CATCHUP:
+                missed.append(due)
+                due = schedule.spec.next_after(due)
+            if missed and schedule.catchup != "skip":
+                print("{} missed {} scheduled runs, catching up ({})".format(schedule.taskname, len(missed),
+                                                                         schedule.catchup))
+                for due in missed if schedule.catchup == "all" else missed[-1:]:
+                    self.fire(schedule, due, skip_running=False)
+        self.push(schedule, schedule.spec.next_after(now))
+
+    def push(self, schedule, due):
+        schedule.due = due
+        self.seq += 1
+        heapq.heappush(self.heap, (due, self.seq, schedule))
+
+    def fire(self, schedule, due, skip_running=True):
+        if skip_running and schedule.running():
+            print("Skipping scheduled run of {}, the previous run ({}) hasn't finished".format(
+                schedule.taskname, schedule.last.id))
+            return
+        try:
+            task = self.registry.get(schedule.taskname)
+            job = self.executor.new_job(task, {"scheduled": due})
+            print("Queueing scheduled run of {} as {}".format(schedule.taskname, job.id))
+            self.executor.q.put(job)
+            schedule.last = job
+        except QueueFull:
+            print("Skipping scheduled run of {}, the job queue is full".format(schedule.taskname))
+        except Exception:
+            print("Could not queue scheduled run of {}:\n{}".format(schedule.taskname, traceback.format_exc()))
+        self.lastrun[schedule.taskname] = due
+        self.save_state()
+
+    def run(self):
+        next_scan = 0
+        with self.cond:
+            while not self.closed:
+                now = time()
+                if now >= next_scan:
+                    self.scan()
+                    next_scan = now + self.rescan_interval
+                while self.heap and self.heap[0][0] <= now:
+                    due, _, schedule = heapq.heappop(self.heap)
+                    if self.schedules.get(schedule.taskname) is not schedule or schedule.due != due:
+                        continue  # replaced or removed since it was pushed
+                    self.fire(schedule, due)
+                    self.push(schedule, schedule.spec.next_after(max(due, now)))
+                wake = min(self.heap[0][0], next_scan) if self.heap else next_scan
+                self.cond.wait(max(0, wake - time()))
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
@@ -0,0 +1,688 @@
+import os
+import cherrypy
+import logging
+import json
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Semaphore, Lock, Timer
+import traceback
+import base64
+import tempfile
+from time import sleep
+from shipper.joblog import read_events, prune_logs
+from shipper.plan import Planner, TimingHistory
+from shipper.jobqueue import Lane, QueuedJob, QueueFull, MemoryJobQueue, SqliteJobQueue, FAILED, CANCELLED, \
+    TIMED_OUT
+from shipper.metrics import MetricsRegistry, Counter, Gauge, Histogram
+from shipper.registry import TaskRegistry
+from shipper.scheduler import Scheduler
+from shipper.cluster import Coordinator, CoordinatorClient, RemoteJobQueue
+from shipper.runners import SpawnRunner, WarmRunner
+
+
+class AppWeb(object):
+    def __init__(self, executor, coordinator=None, worker_token=None):
+        self.executor = executor
+        self.task = TaskWeb(executor)
+        self.job = JobWeb(executor)
+        if coordinator:
+            self.worker = WorkerWeb(coordinator, worker_token)
+
+    @cherrypy.expose
+    def index(self):
+        yield "Hi! Welcome to the Shipper API server."
+
+    @cherrypy.expose
+    def metrics(self):
+        cherrypy.response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+        return self.executor.metrics.render()
+
+
+@cherrypy.popargs("task")
+class TaskWeb(object):
+    def __init__(self, executor):
+        self.executor = executor
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def index(self, task, **kwargs):
+        # called directly rather than via the engine bus so HTTP errors (401, 404, 503) reach the client. The job
+        # only gets queued here; the response doesn't wait for it to start.
+        job = self.executor.enqueue(task, kwargs)
+        cherrypy.response.status = 202
+        return {"id": job.id, "state": job.state}
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def plan(self, task, **kwargs):
+        """
+        What triggering the task with the same parameters would run, without running it
+        """
+        return self.executor.plan(task, kwargs)
+
+
+@cherrypy.popargs("jobid")
+class JobWeb(object):
+    """
+    Job status and logs: /job/ lists recent jobs, /job/<id> returns one job's status, /job/<id>/log its output,
+    /job/<id>/events its structured log events, POST /job/<id>/cancel stops it and POST /job/<id>/resume re-runs a
+    failed resumable job from the failing task
+    """
+    def __init__(self, executor):
+        self.executor = executor
+
+    def get_job(self, jobid):
+        job = self.executor.q.lookup(jobid)
+        if job is None:
+            raise cherrypy.NotFound()
+        return job
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def index(self, jobid=None, limit=100):
+        if jobid is None:
+            try:
+                limit = int(limit)
+            except ValueError:
+                raise cherrypy.HTTPError(400, "Invalid limit")
+            if limit < 0:
+                raise cherrypy.HTTPError(400, "Invalid limit")
+            return [job.to_dict() for job in self.executor.q.recent(limit)]
+        return self.get_job(jobid).to_dict()
+
+    @cherrypy.expose
+    @cherrypy.tools.allow(methods=["POST"])
+    @cherrypy.tools.json_out()
+    def cancel(self, jobid):
+        job = self.get_job(jobid)
+        if not self.executor.cancel(job):
+            raise cherrypy.HTTPError(409, "Job is already {}".format(job.state))
+        return job.to_dict()
+
+    @cherrypy.expose
+    @cherrypy.tools.allow(methods=["POST"])
+    @cherrypy.tools.json_out()
+    def resume(self, jobid):
+        job = self.executor.resume(self.get_job(jobid))
+        cherrypy.response.status = 202
+        return {"id": job.id, "state": job.state, "resume_from": job.resume_from}
+
+    @cherrypy.expose
+    def log(self, jobid, offset=0, follow=False):
+        """
+        Stream the job's log starting at byte `offset` (or the start of a "Range: bytes=N-" header). With `follow`,
+        the response stays open and new output is sent as it is written until the job finishes. Ranges of finished
+        jobs' logs are answered with 206; while the log may still grow its length is unknown, so with 200.
+        """
+        job = self.get_job(jobid)
+        path = self.executor.logpath(job)
+        if path is None:
+            raise cherrypy.NotFound()
+        byterange = cherrypy.request.headers.get("Range", "")
+        ranged = byterange.startswith("bytes=") and byterange.endswith("-")
+        try:
+            offset = int(byterange[len("bytes="):-1] if ranged else offset)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "Invalid offset")
+        if offset < 0:
+            raise cherrypy.HTTPError(400, "Invalid offset")
+        follow = follow not in (False, "0", "false")
+        if not os.path.exists(path) and not follow:
+            raise cherrypy.NotFound()
+        if ranged and job.finished and os.path.exists(path):
+            size = os.path.getsize(path)
+            if offset >= size:
+                cherrypy.response.headers["Content-Range"] = "bytes */{}".format(size)
+                raise cherrypy.HTTPError(416)
+            cherrypy.response.status = 206
+            cherrypy.response.headers["Content-Range"] = "bytes {}-{}/{}".format(offset, size - 1, size)
+        cherrypy.response.headers["Content-Type"] = "text/plain; charset=utf-8"
+        return self.tail(job, path, offset, follow)
+
+    log._cp_config = {"response.stream": True}
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def events(self, jobid, task=None, ev=None):
+        """
+        The job's log events so far, optionally only those of `task` or of type `ev` (start, end, out, job, job_end)
+        """
+        path = self.executor.eventspath(self.get_job(jobid))
+        if path is None or not os.path.exists(path):
+            raise cherrypy.NotFound()
+        return [event for event in read_events(path)
+                if (task is None or event.get("task") == task) and (ev is None or event["ev"] == ev)]
+
+    def tail(self, job, path, offset, follow, chunk_size=65536, interval=0.5):
+        f = None
+        try:
+            while True:
+                if f is None and os.path.exists(path):
+                    f = open(path, "rb")
+                    f.seek(offset)
+                chunk = f.read(chunk_size) if f else b""
+                if chunk:
+                    yield chunk
+                    continue
+                if not follow or job.finished:
+                    # one more read in case output arrived between the last read and the job finishing
+                    rest = f.read() if f else b""
+                    if rest:
+                        yield rest
+                    return
+                sleep(interval)
+        finally:
+            if f:
+                f.close()
+
+
+class WorkerWeb(object):
+    """
+    API used by worker nodes to lease jobs from a coordinator, see shipper.cluster
+    """
+    def __init__(self, coordinator, token=None):
+        self.coordinator = coordinator
+        self.token = token
+
+    def check_token(self):
+        if self.token and cherrypy.request.headers.get("Authorization") != "Bearer " + self.token:
+            raise cherrypy.HTTPError(401, "Invalid worker token")
+
+    @cherrypy.expose
+    @cherrypy.tools.allow(methods=["POST"])
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out()
+    def lease(self):
+        self.check_token()
+        req = cherrypy.request.json
+        job = self.coordinator.lease(req["worker"], req.get("labels", []), min(float(req.get("wait", 10)), 30))
+        if job is None:
+            cherrypy.response.status = 204
+            return None
+        return {"id": job.id, "name": job.name, "args": job.args, "queued": job.queued, "timeout": job.timeout,
+                "resume_from": job.resume_from, "lease_ttl": self.coordinator.lease_ttl}
+
+    @cherrypy.expose
+    @cherrypy.tools.allow(methods=["POST"])
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out()
+    def heartbeat(self):
+        self.check_token()
+        req = cherrypy.request.json
+        return {"kill": self.coordinator.heartbeat(req["worker"], req.get("jobs", []))}
+
+    @cherrypy.expose
+    @cherrypy.tools.allow(methods=["POST"])
+    @cherrypy.tools.json_out()
+    def log(self, worker, job, offset):
+        self.check_token()
+        cl = cherrypy.request.headers.get("Content-Length")
+        data = cherrypy.request.body.read(int(cl)) if cl else b""
+        try:
+            size = self.coordinator.append_log(worker, job, int(offset), data)
+        except ValueError as e:
+            raise cherrypy.HTTPError(409, str(e))
+        if size is None:
+            raise cherrypy.HTTPError(409, "Job is not leased to this worker")
+        return {"size": size}
+
+    @cherrypy.expose
+    @cherrypy.tools.allow(methods=["POST"])
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out()
+    def finish(self):
+        self.check_token()
+        req = cherrypy.request.json
+        job = self.coordinator.finish(req["worker"], req["job"], req.get("returncode"), req.get("state"),
+                                      req.get("stats"))
+        if job is None:
+            raise cherrypy.HTTPError(409, "Job is not leased to this worker")
+        return job.to_dict()
+
+
+class TaskExecutor(object):
+    def __init__(self, runner, registry=None, workers=5, jobqueue=None, logdir=None, job_timeout=None, labels=None,
+                 compress_logs=False, log_max_age=None, log_max_bytes=None):
+        self.q = jobqueue or MemoryJobQueue()
+        self.labels = labels
+        self.logdir = logdir
+        self.compress_logs = compress_logs
+        self.log_max_age = log_max_age
+        self.log_max_bytes = log_max_bytes
+        self.job_timeout = job_timeout
+        self.history = TimingHistory(os.path.join(logdir, "timings.json") if logdir else None)
+        self.planner = Planner(self.history)
+        self.killed = {}
+        self.killed_lock = Lock()
+        self.jobrunner = runner
+        self.workers = workers
+        self.registry = registry or TaskRegistry()
+        self.busy = 0
+        self.busy_lock = Lock()
+        self.setup_metrics()
+        self.runner = Thread(target=self.run, daemon=True)
+        if self.workers:  # a coordinator only hands jobs out
+            self.runner.start()
+        if self.logdir and (self.log_max_age or self.log_max_bytes):
+            Thread(target=self.prune_loop, daemon=True).start()
+
+    def setup_metrics(self):
+        self.metrics = MetricsRegistry()
+        m = self.metrics
+        self.m_jobs = m.add(Counter("shipper_jobs_total", "Jobs finished, by final state", ("job", "state")))
+        self.m_queue_wait = m.add(Histogram("shipper_job_queue_wait_seconds",
+                                            "Time from a job being queued to a worker picking it up", ("job", "lane")))
+        self.m_start_latency = m.add(Histogram("shipper_job_start_latency_seconds",
+                                               "Time from a worker picking up a job to its first task starting",
+                                               ("job", )))
+        self.m_runtime = m.add(Histogram("shipper_job_duration_seconds", "Total job runtime", ("job", "state")))
+        self.m_task = m.add(Histogram("shipper_task_duration_seconds", "Runtime of individual tasks",
+                                      ("job", "task_class", "ok")))
+        m.add(Gauge("shipper_queue_depth", "Jobs waiting to run", func=self.q.depth))
+        m.add(Gauge("shipper_workers", "Size of the worker pool", func=lambda: self.workers))
+        m.add(Gauge("shipper_workers_busy", "Workers currently running a job", func=lambda: self.busy))
+
+    def logpath(self, job):
+        if self.logdir:
+            return os.path.join(self.logdir, job.id + ".log")
+
+    def eventspath(self, job):
+        if self.logdir:
+            return os.path.join(self.logdir, job.id + (".events.gz" if self.compress_logs else ".events"))
+
+    def statspath(self, job):
+        return os.path.join(self.logdir or tempfile.gettempdir(), job.id + ".stats.json")
+
+    def statedir(self, jobid):
+        return os.path.join(self.logdir or tempfile.gettempdir(), jobid + ".state")
+
+    def load_task(self, taskname):
+        return self.registry.get(taskname).module
+
+    def enqueue(self, taskname, params):
+        """
+        validate & load task object, append to the work queue
+        """
+        # Load the job object. The registry only recompiles the task file when it has changed on disk
+        try:
+            task = self.registry.get(taskname)
+        except FileNotFoundError:
+            raise cherrypy.NotFound()
+
+        # check auth before the body is read so unauthorized senders are turned away cheaply
+        self.authorize(task, params)
+        payload = self.read_payload(params)
+
+        job = self.new_job(task, params)
+        if task.coalesce or task.debounce:
+            # runs for the same task and branch replace each other while queued
+            ref = payload.get("ref") if isinstance(payload, dict) else params.get("ref")
+            job.key = "{}:{}".format(taskname, ref or "")
+            job.coalesce = True
+        if task.debounce:
+            job.not_before = job.queued + task.debounce
+        print("Queueing: {} as {}".format(taskname, job.id))
+        self.put(job)
+        return job
+
+    def plan(self, taskname, params):
+        """
+        Plan a run of `taskname` with the request's parameters. Invalid job files are planned too, to report the error.
+        """
+        try:
+            task = self.registry.get(taskname)
+        except FileNotFoundError:
+            raise cherrypy.NotFound()
+        except Exception:
+            task = None
+        if task is not None:
+            self.authorize(task, params)
+        self.read_payload(params)
+        try:
+            return self.planner.plan(self.registry, taskname, params)
+        except FileNotFoundError:
+            raise cherrypy.NotFound()
+
+    def authorize(self, task, params):
+        """
+        Check the request's credentials if required by the job, adding them to the job's `params`
+        """
+        if task.auth is not None:
+            auth = None
+            auth_header = cherrypy.request.headers.get('authorization')
+            if auth_header:
+                try:
+                    authtype, rest = auth_header.split(maxsplit=1)
+                    if authtype.lower() == "basic":
+                        auth = tuple(base64.standard_b64decode(rest.encode("ascii")).decode("utf-8").split(":", 1))
+                except (ValueError, UnicodeError):
+                    auth = None
+
+            if auth not in task.auth:
+                cherrypy.serving.response.headers['www-authenticate'] = 'Basic realm="{}"'.format(task.name)
+                raise cherrypy.HTTPError(401, 'You are not authorized to access that job')
+            params["auth"] = auth
+
+    def read_payload(self, params):
+        """
+        Extract post body if present - we decode json and pass through other types as-is. The body size is capped by
+        server.max_request_body_size
+        """
+        payload = None
+        if cherrypy.request.method == "POST":
+            cl = cherrypy.request.headers.get('Content-Length', None)
+            if cl:
+                payload = cherrypy.request.body.read(int(cl))
+                ctype = cherrypy.request.headers.get('Content-Type', None)
+                if ctype == "application/json":
+                    try:
+                        payload = json.loads(payload)
+                    except ValueError:
+                        raise cherrypy.HTTPError(400, 'Invalid JSON body')
+        if payload:
+            params["payload"] = payload
+        return payload
+
+    def new_job(self, task, params, **kwargs):
+        """
+        Create a job running LoadedTask `task` with the task's queueing settings. When jobs are run here rather than by
+        worker nodes, one requiring labels this node doesn't have could never run, so it is refused.
+        """
+        if self.workers and self.labels is not None and not self.labels.issuperset(task.requires):
+            raise cherrypy.HTTPError(409, "No node has the labels {} requires: {}".format(
+                task.name, ", ".join(sorted(set(task.requires) - self.labels))))
+        return QueuedJob(task.name, params, concurrency=task.concurrency, lane=task.lane, priority=task.priority,
+                         hosts=task.hosts, timeout=task.timeout or self.job_timeout, requires=task.requires, **kwargs)
+
+    def put(self, job):
+        try:
+            self.q.put(job)
+        except QueueFull:
+            cherrypy.serving.response.headers['retry-after'] = '30'
+            raise cherrypy.HTTPError(503, 'The job queue is full')
+
+    def resume(self, failed):
+        """
+        Queue a new run of `failed` that continues from the task that failed
+        """
+        if failed.state not in (FAILED, TIMED_OUT, CANCELLED):
+            raise cherrypy.HTTPError(409, "Job is {}".format(failed.state))
+        if not os.path.isdir(self.statedir(failed.id)):
+            raise cherrypy.HTTPError(409, "Job left no progress to resume from")
+        try:
+            task = self.registry.get(failed.name)
+        except FileNotFoundError:
+            raise cherrypy.NotFound()
+        job = self.new_job(task, failed.args, resume_from=failed.id)
+        print("Queueing: {} as {}, resuming {}".format(failed.name, job.id, failed.id))
+        self.put(job)
+        return job
+
+    def run(self):
+        slots = Semaphore(self.workers)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while True:
+                slots.acquire()  # only take a job off the queue once a worker is free to run it
+                pool.submit(self.run_job, self.q.get(self.labels), slots)
+
+    def cancel(self, job):
+        """
+        Cancel a queued or running job. Returns False if the job has already finished.
+        """
+        if self.q.cancel(job):
+            print("Cancelled queued job {}".format(job.id))
+            return True
+        return self.kill(job, CANCELLED)
+
+    def kill(self, job, state):
+        """
+        Kill running `job`, which will be finished in `state`
+        """
+        with self.killed_lock:
+            if job.id in self.killed:
+                return True
+            self.killed[job.id] = state
+        if self.jobrunner.kill(job):
+            print("Killing job {} ({})".format(job.id, state))
+            return True
+        with self.killed_lock:
+            self.killed.pop(job.id, None)
+        return False
+
+    def run_job(self, job, slots):
+        returncode = None
+        statsfile = self.statspath(job)
+        timer = None
+        if job.timeout:
+            timer = Timer(job.timeout, self.kill, (job, TIMED_OUT))
+            timer.daemon = True
+        with self.busy_lock:
+            self.busy += 1
+        try:
+            print("Executing task from {}.py".format(job.name))
+            if timer:
+                timer.start()
+            statedir = self.statedir(job.id)
+            if job.resume_from:
+                os.rename(self.statedir(job.resume_from), statedir)
+            returncode = self.jobrunner.run(job, self.logpath(job), statsfile, statedir, self.eventspath(job))
+        except:
+            print(traceback.format_exc())
+            # TODO job logging and exception logging
+        finally:
+            if timer:
+                timer.cancel()
+            self.complete(job, returncode)
+            with self.busy_lock:
+                self.busy -= 1
+            slots.release()
+        print("Task complete")
+
+    def complete(self, job, returncode, state=None):
+        """
+        Record the result of a job that has finished running, here or on a worker node
+        """
+        with self.killed_lock:
+            state = self.killed.pop(job.id, None) or state
+        self.q.finish(job, returncode, state)
+        self.record_metrics(job, self.statspath(job))
+
+    def prune_loop(self, interval=600):
+        """
+        Delete the logs of old jobs according to the retention settings, every `interval` seconds
+        """
+        while True:
+            try:
+                pruned = prune_logs(self.logdir, self.log_max_age, self.log_max_bytes, keep=self.q.unfinished())
+                if pruned:
+                    print("Pruned the logs of {} old jobs".format(pruned))
+            except Exception:
+                print(traceback.format_exc())
+            sleep(interval)
+
+    def record_metrics(self, job, statsfile):
+        self.m_jobs.inc(job=job.name, state=job.state)
+        self.m_queue_wait.observe(job.started - job.queued, job=job.name, lane=job.lane)
+        self.m_runtime.observe(job.finished - job.started, job=job.name, state=job.state)
+        try:
+            with open(statsfile) as f:
+                stats = json.load(f)
+            os.unlink(statsfile)
+        except (OSError, ValueError):
+            return
+        tasks = stats.get("tasks", [])
+        self.history.record(job.name, tasks)
+        if tasks:
+            self.m_start_latency.observe(max(0, min(t["start"] for t in tasks) - job.started), job=job.name)
+        for timing in tasks:
+            self.m_task.observe(timing["duration"], job=job.name, task_class=timing["class"],
+                                ok=str(timing["ok"]).lower())
+
+
+def main():
+    import argparse
+    import signal
+
+    parser = argparse.ArgumentParser(description="Shipper API server")
+
+    parser.add_argument('-p', '--port', default=8080, type=int, help="tcp port to listen on")
+    parser.add_argument('-t', '--tasks', default="./", help="dir containing task files")
+    parser.add_argument('--runner', choices=["spawn", "warm"], default="spawn",
+                        help="start a new interpreter per job, or fork jobs from a pool of pre-started runners")
+    parser.add_argument('--threads', default=5, type=int, help="number of http request threads")
+    parser.add_argument('--socket-queue', default=5, type=int, help="listen backlog of the http socket")
+    parser.add_argument('--max-body', default=10 * 1024 * 1024, type=int,
+                        help="max request body size in bytes, larger requests are rejected with 413")
+    parser.add_argument('--workers', default=5, type=int, help="number of jobs to run at once")
+    parser.add_argument('--lane', action="append", default=[], metavar="NAME[:PRIORITY[:LIMIT]]",
+                        help="define a job lane; ready jobs in higher priority lanes start first and at most LIMIT "
+                             "jobs of the lane run at once (repeatable)")
+    parser.add_argument('--host-limit', default=0, type=int,
+                        help="max number of running jobs that target the same remote host (default: unlimited)")
+    parser.add_argument('--job-timeout', type=float,
+                        help="kill jobs that run for longer than this many seconds, unless the job file sets a timeout")
+    parser.add_argument('--kill-grace', default=10, type=float,
+                        help="seconds between asking a killed job to exit and forcibly killing it")
+    parser.add_argument('--queue-db', help="persist the job queue to this sqlite database")
+    parser.add_argument('--queue-size', default=0, type=int,
+                        help="max number of queued jobs, further requests are rejected with 503 (default: unbounded)")
+    parser.add_argument('--logs', default=os.path.join(tempfile.gettempdir(), "shipper-logs"),
+                        help="dir to write job logs to")
+    parser.add_argument('--compress-logs', action="store_true", help="gzip the structured log events of jobs")
+    parser.add_argument('--log-max-age', type=float, metavar="DAYS",
+                        help="delete the logs of jobs that finished more than this many days ago")
+    parser.add_argument('--log-max-size', type=float, metavar="MB",
+                        help="delete the logs of the oldest jobs while the log dir is larger than this")
+    parser.add_argument('--schedule-state',
+                        help="file to remember when scheduled jobs last ran in (default: schedules.json in the log "
+                             "dir)")
+    parser.add_argument('--mode', choices=["standalone", "coordinator", "worker"], default="standalone",
+                        help="run jobs here, only queue jobs for worker nodes to lease, or lease and run jobs from "
+                             "the --coordinator")
+    parser.add_argument('--coordinator', metavar="URL", help="base url of the coordinator, in worker mode")
+    parser.add_argument('--labels', default="",
+                        help="comma separated labels of this node; jobs only run on nodes having all the labels in "
+                             "their 'requires'")
+    parser.add_argument('--worker-token', default=os.environ.get("SHIPPER_WORKER_TOKEN"),
+                        help="shared secret workers authenticate to the coordinator with "
+                             "(default: $SHIPPER_WORKER_TOKEN)")
+    parser.add_argument('--lease-ttl', default=30, type=float,
+                        help="seconds without a heartbeat after which a worker's job is given to another worker")
+    parser.add_argument('--debug', action="store_true", help="enable development options")
+
+    args = parser.parse_args()
+    try:
+        lanes = [Lane.parse(spec) for spec in args.lane]
+    except ValueError as e:
+        parser.error(str(e))
+    if args.mode == "worker" and not args.coordinator:
+        parser.error("--coordinator is required in worker mode")
+    labels = frozenset(label.strip() for label in args.labels.split(",") if label.strip())
+
+    logging.basicConfig(level=logging.INFO if args.debug else logging.WARNING,
+                        format="%(asctime)-15s %(levelname)-8s %(filename)s:%(lineno)d %(message)s")
+
+    runnerpath = os.path.join(os.path.abspath(os.path.dirname(__file__)), "runjob.py")
+    if args.queue_db:
+        args.queue_db = os.path.abspath(args.queue_db)
+    args.logs = os.path.abspath(args.logs)
+    args.schedule_state = os.path.abspath(args.schedule_state or os.path.join(args.logs, "schedules.json"))
+    os.makedirs(args.logs, exist_ok=True)
+    os.chdir(args.tasks)
+
+    if args.mode == "worker":
+        run_worker(args, runnerpath, labels)
+        return
+
+    cherrypy.config.update({
+        'tools.sessions.on': False,
+        # 'tools.sessions.locking': 'explicit',
+        # 'tools.sessions.timeout': 525600,
+        'request.show_tracebacks': True,
+        'server.socket_port': args.port,
+        'server.thread_pool': args.threads,
+        'server.socket_queue_size': args.socket_queue,
+        'server.max_request_body_size': args.max_body,
+        'server.socket_host': '0.0.0.0',
+        # 'log.screen': False,
+        'engine.autoreload.on': args.debug
+    })
+
+    coordinator = None
+    if args.mode == "coordinator":
+        runner = coordinator = Coordinator(lease_ttl=args.lease_ttl)
+    else:
+        runner = make_runner(args, runnerpath)
+    cherrypy.engine.subscribe('stop', runner.close)
+
+    if args.queue_db:
+        jobqueue = SqliteJobQueue(args.queue_db, maxsize=args.queue_size, lanes=lanes, host_limit=args.host_limit)
+    else:
+        jobqueue = MemoryJobQueue(maxsize=args.queue_size, lanes=lanes, host_limit=args.host_limit)
+    cherrypy.engine.subscribe('stop', jobqueue.close)
+
+    executor = TaskExecutor(runner, workers=0 if coordinator else args.workers, jobqueue=jobqueue, logdir=args.logs,
+                            job_timeout=args.job_timeout, labels=labels, **log_options(args))
+    if coordinator:
+        coordinator.executor = executor
+
+    scheduler = Scheduler(executor, statefile=args.schedule_state)
+    scheduler.start()
+    cherrypy.engine.subscribe('stop', scheduler.close)
+
+    web = AppWeb(executor, coordinator, args.worker_token)
+    cherrypy.tree.mount(web, '/', {'/': {'tools.trailing_slash.on': False}})
+
+    def signal_handler(signum, stack):
+        logging.critical('Got sig {}, exiting...'.format(signum))
+        cherrypy.engine.exit()
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    try:
+        cherrypy.engine.start()
+        cherrypy.engine.block()
+    finally:
+        logging.info("API has shut down")
+        cherrypy.engine.exit()
+
+
+def log_options(args):
+    return {"compress_logs": args.compress_logs,
+            "log_max_age": args.log_max_age * 86400 if args.log_max_age else None,
+            "log_max_bytes": int(args.log_max_size * 1024 * 1024) if args.log_max_size else None}
+
+
+def make_runner(args, runnerpath):
+    if args.runner == "warm":
+        return WarmRunner(runnerpath, size=args.workers, kill_grace=args.kill_grace)
+    return SpawnRunner(runnerpath, kill_grace=args.kill_grace)
+
+
+def run_worker(args, runnerpath, labels):
+    """
+    Worker node: lease jobs from the coordinator and run them here until interrupted. The HTTP API, scheduler and
+    metrics are served by the coordinator.
+    """
+    import signal
+    from threading import Event
+
+    runner = make_runner(args, runnerpath)
+    jobqueue = RemoteJobQueue(CoordinatorClient(args.coordinator, args.worker_token))
+    executor = TaskExecutor(runner, workers=args.workers, jobqueue=jobqueue, logdir=args.logs,
+                            job_timeout=args.job_timeout, labels=labels, **log_options(args))
+    jobqueue.executor = executor
+    print("Worker {} running up to {} jobs from {} with labels {}".format(
+        jobqueue.worker, args.workers, args.coordinator, ",".join(sorted(labels)) or "(none)"))
+
+    stop = Event()
+    signal.signal(signal.SIGINT, lambda signum, stack: stop.set())
+    signal.signal(signal.SIGTERM, lambda signum, stack: stop.set())
+    stop.wait()
+    logging.critical("Worker exiting")
+    jobqueue.close()
+    runner.close()
+
+
+if __name__ == '__main__':
+    main()